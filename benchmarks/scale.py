@@ -0,0 +1,182 @@
+"""
+End-to-end benchmark of sweeps on synthetic sweeps.
+
+For each number of points, makes a project in a temporary directory and
+times, each in a fresh interpreter so that its peak memory is its own:
+
+    create  create_rfs of a sweep of that many points
+    run     run_sweep of up to --run_points of them with a shell script
+            which writes a small JSON result (after sleeping --sleep seconds)
+    query   query_status of the sweep
+    pack    pack_rfs of the finished rfs, with --pack
+    close   close_rfs of the finished rfs
+
+and prints the seconds, throughput in points per second and peak resident
+memory of every stage as JSON, both of the stage's process and of the
+largest of its child processes (the scripts of run, the workers of close). For run, the time per rf is also given net
+of the time the script takes on its own, which is the overhead of the
+scheduler, and compared with a bare pool of --procs threads running the
+script on as many folders. Exits with status 1 if run is more than
+--max_slowdown times slower than that baseline, so that it can be run as
+a check. Projects can be put on another file system with --dir to compare
+e.g. tmpfs and disk, and laid out with --fanout:
+
+    python benchmarks/scale.py --points 1000 100000 --dir /dev/shm --fanout 2
+"""
+import argparse
+import json
+import os, os.path as path
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+STAGE = """
+import json, resource, sys, time
+import sweeps
+project_dir, args = sys.argv[1], json.loads(sys.argv[2])
+start = time.perf_counter()
+%s
+seconds = time.perf_counter() - start
+unit = 2**20 if sys.platform == 'darwin' else 2**10
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+print(json.dumps({'seconds': seconds, 'peak_mb': peak, 'children_peak_mb': children}))
+"""
+
+STAGES = {
+    'create': "sweeps.create_rfs(project_dir, 'sweep.json', fanout=args['fanout'])",
+    'run': "sweeps.run_sweep(project_dir, 'sh', 'bin/script.sh', args['procs'], 'run.json')",
+    'query': "sweeps.query_status(project_dir, 'bin/script.sh')",
+    'pack': "sweeps.pack_rfs(project_dir, 'run.json')",
+    'close': "sweeps.close_rfs(project_dir, 'run.json', args['procs'])",
+}
+
+def run_stage(name, project_dir, package_dir, **args):
+    # the measurements are printed on the last line, after the output of sweeps
+    output = subprocess.run([sys.executable, '-c', STAGE % STAGES[name], project_dir,\
+        json.dumps(args)], check=True, cwd=package_dir, stdout=subprocess.PIPE,\
+        universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+def make_project(project_dir, points, sleep):
+    os.mkdir(path.join(project_dir, 'bin'))
+    with open(path.join(project_dir, 'bin', 'script.sh'), 'w') as file:
+        if sleep:
+            file.write("sleep %g\n" % sleep)
+        file.write("echo '{\"value\": 1}' > \"$1/result.json\"\n")
+    # a square grid of points, as sweeps usually have several parameters
+    width = int(points ** 0.5)
+    while points % width:
+        width -= 1
+    sweep = {'a': {'sweep_type': 'manual', 'value': list(range(points // width))},
+        'b': {'sweep_type': 'manual', 'value': list(range(width))}}
+    with open(path.join(project_dir, 'sweep.json'), 'w') as file:
+        json.dump(sweep, file)
+    return sweep
+
+def write_run_sweep(project_dir, sweep, count):
+    # the first count points of the sweep, which run_sweep moves to history
+    values = sweep['b']['value']
+    points = [{'a': index // len(values), 'b': values[index % len(values)]}\
+        for index in range(count)]
+    with open(path.join(project_dir, 'run.json'), 'w') as file:
+        json.dump({'_points': points}, file)
+
+def script_time(project_dir, repeat=10):
+    # the fastest of several runs of the script on its own
+    rf_dir = tempfile.mkdtemp(dir=project_dir)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(['sh', path.join(project_dir, 'bin', 'script.sh'), rf_dir], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def baseline_time(project_dir, count, procs):
+    # count runs of the script by a bare pool of procs threads, each in a
+    # folder of its own, which is what the scheduler adds its overhead to
+    base_dir = tempfile.mkdtemp(dir=project_dir)
+    rf_dirs = [path.join(base_dir, str(index)) for index in range(count)]
+    for rf_dir in rf_dirs:
+        os.mkdir(rf_dir)
+    script_path = path.join(project_dir, 'bin', 'script.sh')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(procs) as pool:
+        list(pool.map(lambda rf_dir: subprocess.run(['sh', script_path, rf_dir], check=True,\
+            stdout=subprocess.DEVNULL), rf_dirs))
+    return time.perf_counter() - start
+
+def benchmark(points, args, package_dir):
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as project_dir:
+        sweep = make_project(project_dir, points, args.sleep)
+        run_points = min(points, args.run_points)
+        options = dict(fanout=args.fanout, procs=args.procs)
+        stages = ['create', 'run', 'query'] + (['pack'] if args.pack else []) + ['close']
+        for name in stages:
+            if name in ('run', 'pack', 'close'):
+                write_run_sweep(project_dir, sweep, run_points)
+            count = points if name in ('create', 'query') else run_points
+            result = dict(stage=name, points=count)
+            result.update(run_stage(name, project_dir, package_dir, **options))
+            result['throughput'] = count / result['seconds']
+            if name == 'run':
+                result['per_rf_ms'] = 1000 * result['seconds'] / count
+                result['script_ms'] = 1000 * script_time(project_dir)
+                # each of procs workers runs an rf at a time
+                result['overhead_ms'] = result['per_rf_ms'] * args.procs - result['script_ms']
+                baseline = baseline_time(project_dir, count, args.procs)
+                result['baseline_ms'] = 1000 * baseline / count
+                result['slowdown'] = result['seconds'] / baseline
+            results.append(result)
+            print("%d points: %s %.2fs (%.0f points/s, %.0fMB, children %.0fMB)" % (points,\
+                name, result['seconds'], result['throughput'], result['peak_mb'],\
+                result['children_peak_mb']), file=sys.stderr)
+            if name == 'run':
+                print("%d points: run %.1fx the baseline of %.2fs%s" % (points,\
+                    result['slowdown'], result['seconds'] / result['slowdown'],\
+                    " OVER BUDGET" if result['slowdown'] > args.max_slowdown else ""),\
+                    file=sys.stderr)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sweeps on synthetic sweeps")
+    parser.add_argument('--points', type=int, nargs='+', default=[1000, 10000, 100000],\
+        help="numbers of points of the sweeps (default: 1000 10000 100000)")
+    parser.add_argument('--run_points', type=int, default=10000, metavar="N",\
+        help="number of points which are run and closed (default: 10000)")
+    parser.add_argument('--procs', type=int, default=4,\
+        help="number of processes to run and close with (default: 4)")
+    parser.add_argument('--sleep', type=float, default=0, metavar="SECONDS",\
+        help="time the script sleeps (default: 0)")
+    parser.add_argument('--fanout', type=int, default=None,\
+        help="fanout of the layout of the projects (see sweeps create)")
+    parser.add_argument('--pack', action='store_true',\
+        help="pack the finished rfs before closing them")
+    parser.add_argument('--dir', default=None,\
+        help="directory to make the projects in (default: the temporary directory)")
+    parser.add_argument('--max_slowdown', type=float, default=3, metavar="FACTOR",\
+        help="times a bare pool's time run may take (default: 3)")
+    parser.add_argument('--output', default=None,\
+        help="file to write the results to (default: standard output)")
+    args = parser.parse_args()
+
+    package_dir = path.dirname(path.dirname(path.abspath(__file__)))
+    report = dict(python=sys.version.split()[0], platform=sys.platform, procs=args.procs,\
+        sleep=args.sleep, fanout=args.fanout, pack=args.pack,\
+        dir=path.abspath(args.dir or tempfile.gettempdir()), results=[])
+    for points in args.points:
+        report['results'].extend(benchmark(points, args, package_dir))
+
+    if args.output is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+    sys.exit(1 if any(result['slowdown'] > args.max_slowdown\
+        for result in report['results'] if result['stage'] == 'run') else 0)
+
+if __name__ == '__main__':
+    main()
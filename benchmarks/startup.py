@@ -0,0 +1,84 @@
+"""
+Startup benchmark for the sweeps command line.
+
+Times `import sweeps` and `sweeps PROJECT query` against the startup of a
+bare interpreter, and checks that neither imports pandas or numpy. Exits
+with status 1 if the time added by sweeps exceeds the budget, so that it can
+be run as a check:
+
+    python benchmarks/startup.py --budget 250
+"""
+import argparse
+import json
+import os, os.path as path
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ('pandas', 'numpy', 'scipy', 'h5py')
+
+def best_time(command, repeat, cwd=None):
+    # the fastest of several runs, as the others only add noise
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, cwd=cwd, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def heavy_imports(code, cwd=None):
+    # the heavy modules imported are printed on the last line
+    check = code + "\nimport sys; print(' '.join(m for m in %r if m in sys.modules))"\
+        % (HEAVY_MODULES,)
+    output = subprocess.run([sys.executable, '-c', check], check=True, cwd=cwd,\
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return output.splitlines()[-1].split() if output else []
+
+def make_project(project_dir):
+    os.mkdir(path.join(project_dir, 'bin'))
+    with open(path.join(project_dir, 'bin', 'script.py'), 'w') as file:
+        file.write("import sys\n")
+    sweep = {'a': {'sweep_type': 'manual', 'value': list(range(100))},
+        'b': {'sweep_type': 'manual', 'value': list(range(10))}}
+    with open(path.join(project_dir, 'sweep.json'), 'w') as file:
+        json.dump(sweep, file)
+    subprocess.run([sys.executable, '-m', 'sweeps', project_dir, 'create', 'sweep.json'],\
+        check=True, stdout=subprocess.DEVNULL)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the startup of sweeps")
+    parser.add_argument('--budget', type=float, default=250, metavar="MS",\
+        help="allowed time added by sweeps to interpreter startup (default: 250)")
+    parser.add_argument('--repeat', type=int, default=10,\
+        help="number of runs of each command (default: 10)")
+    args = parser.parse_args()
+
+    package_dir = path.dirname(path.dirname(path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as project_dir:
+        make_project(project_dir)
+        query = [sys.executable, '-m', 'sweeps', project_dir, 'query', 'bin/script.py']
+        baseline = best_time([sys.executable, '-c', 'pass'], args.repeat)
+        timings = {
+            'import sweeps': best_time([sys.executable, '-c', 'import sweeps'],\
+                args.repeat, package_dir),
+            'sweeps query': best_time(query, args.repeat, package_dir),
+        }
+        heavy = heavy_imports("import runpy, sys\nsys.argv = %r\n" % (['sweeps'] + query[3:],)\
+            + "runpy.run_module('sweeps', run_name='__main__')", package_dir)
+
+    print("interpreter startup: %.1fms" % (1000 * baseline))
+    failed = False
+    for name, seconds in timings.items():
+        added = 1000 * (seconds - baseline)
+        over = added > args.budget
+        failed |= over
+        print("%s: %.1fms (+%.1fms, budget %.0fms)%s" % (name, 1000 * seconds, added,\
+            args.budget, " OVER BUDGET" if over else ""))
+    if heavy:
+        failed = True
+        print("query imported " + ", ".join(heavy))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
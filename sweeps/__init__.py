@@ -1,7 +1,22 @@
-from .setup_sweep import create_rfs, delete_rfs
-from .close_sweep import close_rfs, get_dataframe
+from .setup_sweep import create_rfs, delete_rfs, migrate_rfs, pack_rfs
 from .run_sweep import run_sweep
-from .sweep_utils import query_status, read_params
+from .sweep_adapt import adapt_sweep
+from .sweep_utils import query_status, read_params, reindex, write_result
+from .sweep_stats import query_stats
+from .sweep_watch import watch_status
+from .sweep_loaders import register_loader
+from .sweep_log import read_log
 
-__all__ = ["create_rfs", "delete_rfs", "close_rfs","get_dataframe","run_sweep", "query_status",\
-    "read_params"]
+__all__ = ["create_rfs", "delete_rfs", "migrate_rfs", "pack_rfs", "close_rfs",\
+    "get_dataframe", "select_results", "LazyResult", "get_array", "load_results",\
+    "run_sweep", "adapt_sweep", "query_status", "read_params", "reindex", "write_result",\
+    "query_stats", "watch_status", "register_loader", "read_log"]
+
+def __getattr__(name):
+    # close_sweep needs pandas and numpy, which take most of a second to
+    # import, so it is only imported once one of its names is used
+    if name in ("close_rfs", "get_dataframe", "select_results", "LazyResult", "get_array",
+            "load_results"):
+        from . import close_sweep
+        return getattr(close_sweep, name)
+    raise AttributeError("module 'sweeps' has no attribute " + repr(name))
@@ -1,7 +1,80 @@
 import argparse
 import multiprocessing
+import signal
+import sys
 
-from sweeps import create_rfs, delete_rfs, close_rfs, run_sweep, query_status
+from sweeps import create_rfs, delete_rfs, migrate_rfs, pack_rfs, run_sweep, query_status, reindex
+from sweeps import adapt_sweep, query_stats, watch_status, read_log
+
+def exit_code(value):
+    # runs killed by a signal exit with minus the signal number
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return -signal.Signals[value.upper()].value
+        except KeyError:
+            raise argparse.ArgumentTypeError("invalid exit code or signal: " + value)
+
+def add_run_arguments(run):
+    # options of the runs, shared by run and adapt
+    run.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),\
+        help="number of processes to use")
+    run.add_argument('--rerun_failed', action='store_true',\
+        help="rerun failed rfs")
+    run.add_argument('--warm', metavar="ENTRY", nargs='?', const='main',\
+        help="keep PROGRAM running as a Python worker which imports SCRIPT once "+
+        "and calls ENTRY(rf_path) (default: main) for each rf")
+    run.add_argument('--recycle', type=int, default=100, metavar="N",\
+        help="restart warm workers after N runs (default: 100)")
+    run.add_argument('--batch', type=int, metavar="K",\
+        help="pass up to K rfs to each invocation of SCRIPT, which reports finished "+
+        "rfs to the file named by $SWEEPS_BATCH_STATUS")
+    run.add_argument('--batch_time', type=float, default=60, metavar="SECONDS",\
+        help="adapt batch sizes to take about SECONDS each (default: 60)")
+    run.add_argument('--distributed', action='store_true',\
+        help="share the rfs with sweeps run on other hosts, claiming each rf before "+
+        "running it")
+    run.add_argument('--lease', type=float, default=600, metavar="SECONDS",\
+        help="take over claims of other hosts not renewed for SECONDS (default: 600)")
+    run.add_argument('--longest_first', action='store_true',\
+        help="run the rfs with the longest predicted wall time first")
+    run.add_argument('--memory', type=float, metavar="MB",\
+        help="keep the predicted peak memory of all running rfs within MB")
+    run.add_argument('--cache', action='store_true',\
+        help="restore the results of rfs run before with the same parameters, PROGRAM "+
+        "and SCRIPT from the project cache instead of running them, and report hit rates")
+    run.add_argument('--depends', metavar="PATH", nargs='+', default=[],\
+        help="files or folders relative to PROJECT which SCRIPT depends on, for --cache")
+    run.add_argument('--cache_size', type=float, default=10240, metavar="MB",\
+        help="evict least recently used cache entries beyond MB (default: 10240)")
+    run.add_argument('--timeout', type=float, metavar="SECONDS",\
+        help="terminate runs after SECONDS and mark them TIMEOUT (default: option "+
+        "_timeout of the sweep file, if any)")
+    run.add_argument('--sweep_timeout', type=float, metavar="SECONDS",\
+        help="start no rfs after SECONDS and terminate the runs still going")
+    run.add_argument('--retry', type=exit_code, nargs='+', default=[], metavar="CODE",\
+        help="retry runs failing with an exit code or signal CODE, e.g. 137 SIGKILL")
+    run.add_argument('--retries', type=int, default=3, metavar="N",\
+        help="retry each rf at most N times (default: 3)")
+    run.add_argument('--backoff', type=float, default=10, metavar="SECONDS",\
+        help="wait up to SECONDS before the first retry of an rf, twice as long before "+
+        "each next (default: 10)")
+    run.add_argument('--speculate', type=float, metavar="PERCENTILE",\
+        help="once no rfs are left to start, run rfs running longer than PERCENTILE of "+
+        "the finished runs a second time, keeping the first to finish")
+    run.add_argument('--log_limit', type=float, default=10, metavar="MB",\
+        help="keep the first and last MB/2 of the output of each run in the compressed "+
+        "log of the rf, or all of it if 0 (default: 10)")
+
+def run_options(args):
+    return dict(rerun_failed=args.rerun_failed, warm=args.warm, recycle=args.recycle,\
+        batch=args.batch, batch_time=args.batch_time,\
+        lease=args.lease if args.distributed else None, longest_first=args.longest_first,\
+        memory=args.memory, cache=args.cache, depends=args.depends,\
+        cache_size=args.cache_size, timeout=args.timeout, sweep_timeout=args.sweep_timeout,\
+        retry=args.retry, retries=args.retries, backoff=args.backoff, speculate=args.speculate,\
+        log_limit=int(args.log_limit * 2**20))
 
 def main():
     # Define command-line parser
@@ -15,6 +88,14 @@ def main():
         description="Create rfs from a sweep file")
     create.add_argument('sweep_file', metavar="SWEEP_FILE",\
         help="JSON file specifying sweep")
+    create.add_argument('--shard', type=int, nargs=2, metavar=("I", "N"),\
+        help="only create every N-th rf starting from the I-th (counting from 0), so "+
+        "that N hosts can create a sweep together")
+    create.add_argument('--threads', type=int, default=16,\
+        help="number of threads creating rfs (default: 16)")
+    create.add_argument('--fanout', type=int, choices=range(5),\
+        help="for a new project, place each rf FANOUT levels of folders deep, e.g. "+
+        "rfs/ab/cd/abcd... for 2, to keep folders small (default: 0)")
     delete = subcommands.add_parser('delete',\
         description="Delete rfs from a sweep file")
     delete.add_argument('sweep_file', metavar="SWEEP_FILE",\
@@ -25,35 +106,126 @@ def main():
         help="interpreter for SCRIPT")
     run.add_argument('script_file', metavar="SCRIPT",\
         help="location of script relative to PROJECT")
-    run.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),\
-        help="number of processes to use")
     run.add_argument('--sweep_file', metavar="FILE",\
         help="restrict to rfs consistent with creation from JSON file FILE; "+
         "location relative to PROJECT")
-    run.add_argument('--rerun_failed', action='store_true',\
-        help="rerun failed rfs")
+    add_run_arguments(run)
+    adapt = subcommands.add_parser('adapt',\
+        description="Run an adaptive sweep in rounds of rfs chosen from the results of "+
+        "the previous rounds")
+    adapt.add_argument('program', metavar="PROGRAM",\
+        help="interpreter for SCRIPT")
+    adapt.add_argument('script_file', metavar="SCRIPT",\
+        help="location of script relative to PROJECT")
+    adapt.add_argument('sweep_file', metavar="SWEEP_FILE",\
+        help="JSON file specifying the sweep and its _adaptive option")
+    adapt.add_argument('--rounds', type=int, metavar="N",\
+        help="run up to N rounds in total (default: option rounds of the sweep file)")
+    add_run_arguments(adapt)
     query = subcommands.add_parser('query',\
         description="Print sweep summary for a given script")
     query.add_argument('script_file', metavar="SCRIPT",\
         help="location of script relative to PROJECT")
+    watch = subcommands.add_parser('watch',\
+        description="Follow the status of the rfs for a given script as it changes")
+    watch.add_argument('script_file', metavar="SCRIPT",\
+        help="location of script relative to PROJECT")
+    watch.add_argument('--interval', type=float, default=1, metavar="SECONDS",\
+        help="update at most every SECONDS (default: 1)")
+    watch.add_argument('--window', type=float, default=60, metavar="SECONDS",\
+        help="measure throughput over the last SECONDS (default: 60)")
+    watch.add_argument('--json', action='store_true',\
+        help="print each update as a line of JSON")
+    watch.add_argument('--until_done', action='store_true',\
+        help="exit once no rf is queued or running")
+    stats = subcommands.add_parser('stats',\
+        description="Print resource usage of the runs of a given script")
+    stats.add_argument('script_file', metavar="SCRIPT",\
+        help="location of script relative to PROJECT")
+    stats.add_argument('--by', metavar="PARAM", nargs='+', default=[],\
+        help="also summarize usage per value of each PARAM")
+    stats.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),\
+        help="number of cores available to the sweep")
+    log = subcommands.add_parser('log',\
+        description="Print the log of an rf")
+    log.add_argument('rf', metavar="RF",\
+        help="name of the rf")
+    log.add_argument('--attempt', type=int, metavar="N",\
+        help="only print the log of the N-th run of the rf, from 0, or from the last if "+
+        "negative")
+    subcommands.add_parser('reindex',\
+        description="Rebuild the status index from the rfs status files")
+    migrate = subcommands.add_parser('migrate',\
+        description="Move the rfs to another layout; no sweep may run meanwhile")
+    migrate.add_argument('fanout', type=int, choices=range(5), metavar="FANOUT",\
+        help="levels of folders above each rf, e.g. rfs/ab/cd/abcd... for 2")
+    pack = subcommands.add_parser('pack',\
+        description="Move finished rfs into indexed zip archives in PROJECT/packs")
+    pack.add_argument('--sweep_file', metavar="FILE",\
+        help="only pack rfs of JSON file FILE; location relative to PROJECT")
+    pack.add_argument('--pack_size', type=int, default=10000, metavar="N",\
+        help="number of rfs per archive (default: 10000)")
     close = subcommands.add_parser('close',\
         description="")
     close.add_argument('sweep_file',\
         help="JSON file specifying sweep.")
+    close.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),\
+        help="number of processes to use for reading results")
+    close.add_argument('--chunk_size', type=int, default=1000, metavar="N",\
+        help="number of rfs per part of the results (default: 1000)")
+    close.add_argument('--full', action='store_true',\
+        help="rebuild the closed sweep instead of adding rfs changed since the "+
+        "previous close")
+    select = subcommands.add_parser('select',\
+        description="Print results of closed sweeps whose parameters match")
+    select.add_argument('--where', metavar="EXPR",\
+        help="condition on parameters, e.g. \"a == 1 and c < 40\"")
+    select.add_argument('--columns', metavar="COLUMNS", type=lambda s: s.split(','),\
+        help="comma-separated parameters or 'results' to print")
+    select.add_argument('--sweep', metavar="ID",\
+        help="restrict to the closed sweep data/ID")
 
     # Execute command
     args = sweeps.parse_args()
     if args.subcommand == 'create':
-        create_rfs(args.project_dir, args.sweep_file)
+        create_rfs(args.project_dir, args.sweep_file, args.shard, args.threads,\
+            fanout=args.fanout)
     elif args.subcommand == 'delete':
         delete_rfs(args.project_dir, args.sweep_file)
     elif args.subcommand == 'run':
         run_sweep(args.project_dir, args.program, args.script_file, args.procs,\
-            args.sweep_file, args.rerun_failed)
+            args.sweep_file, **run_options(args))
+    elif args.subcommand == 'adapt':
+        adapt_sweep(args.project_dir, args.program, args.script_file, args.sweep_file,\
+            args.procs, args.rounds, **run_options(args))
     elif args.subcommand == 'query':
         query_status(args.project_dir, args.script_file)
+    elif args.subcommand == 'watch':
+        watch_status(args.project_dir, args.script_file, args.interval, args.json,\
+            args.until_done, args.window)
+    elif args.subcommand == 'stats':
+        query_stats(args.project_dir, args.script_file, args.by, args.procs)
+    elif args.subcommand == 'log':
+        try:
+            sys.stdout.buffer.write(read_log(args.project_dir, args.rf, args.attempt))
+        except ValueError as error:
+            sweeps.error(str(error))
+    elif args.subcommand == 'reindex':
+        reindex(args.project_dir)
+    elif args.subcommand == 'migrate':
+        migrate_rfs(args.project_dir, args.fanout)
+    elif args.subcommand == 'pack':
+        pack_rfs(args.project_dir, args.sweep_file, args.pack_size)
     elif args.subcommand == 'close':
-        close_rfs(args.project_dir, args.sweep_file)
+        from sweeps import close_rfs
+        close_rfs(args.project_dir, args.sweep_file, args.procs, args.chunk_size, args.full)
+    elif args.subcommand == 'select':
+        from sweeps import select_results, LazyResult
+        for df in select_results(args.project_dir, args.where, args.columns, args.sweep,\
+                chunked=True):
+            if 'results' in df:
+                df['results'] = df['results'].map(LazyResult.load)
+            print(df.to_string())
 
 if __name__ == "__main__":
     main()
@@ -3,144 +3,468 @@ import pandas as pd
 import numpy as np
 import math
 import hashlib, json
+import pickle
+import gzip
 import warnings
+import concurrent.futures
 
-from .sweep_utils import Status, collect_rf_status, generate_status, write, get_param_id
-from .setup_sweep import read_sweep
+from .sweep_utils import Status, collect_rf_status, collect_rf_updates, write, get_param_id
+from .sweep_utils import RF_FILES, get_rf_path, read_packs, list_rf_files, open_rf_file
+from .sweep_utils import LOG_FILE, LOG_INDEX
+from .sweep_loaders import find_loader, load_file, read_array_header
+from .sweep_loaders import install_loaders, shared_loaders
+from .sweep_log import copy_log
+from .setup_sweep import read_sweep, read_axes, read_options, read_rounds, rounds_path, point_rf
 
 
-def close_rfs(project_dir, sweep_file):
-    rfs = [rf for rf,_ in read_sweep(sweep_file)]
+def close_rfs(project_dir, sweep_file, procs=None, chunk_size=1000, full=False):
+    """
+    Collect the results of the finished rfs of a sweep into data/<params_id>.
+    Result files are decoded by procs worker processes, chunk_size rfs at a
+    time, and each chunk is written as one part of data/<params_id>/results
+    (Parquet if pyarrow is installed, pickle otherwise).
+
+    Results saved as .npy files of the same shape and dtype in every rf (see
+    sweep_utils.write_result) are instead copied into one array per file
+    name in data/<params_id>/arrays, with an axis per parameter of the sweep
+    (see get_array).
+
+    What has been collected is recorded in data/<params_id>/close.json, so
+    that closing again only reads rfs finished since the previous close and
+    appends the status lines and log output added since. If full, the data
+    directory is rebuilt from scratch instead.
+
+    The compressed logs of the rfs are appended to data/<params_id>/log.gz
+    as they are, without decompressing them (see sweep_log), and the offset
+    at which the log of each rf starts is recorded in log.idx.
+
+    For an adaptive sweep (see sweep_adapt), the round in which each rf was
+    first run is recorded in the column _round.
+    """
+    sweep_filepath = path.join(project_dir,sweep_file)
+    rfs = [rf for rf,_ in read_sweep(sweep_filepath)]
     rf_status = collect_rf_status(project_dir,rfs=rfs)
 
     if rf_status[Status.FAILED]:
         warnings.warn("Warning: Found rfs with status FAILED.")
-    
-    if rf_status[Status.RUNNING]:
-        warnings.warn("Sweeps still running. Rerun sweeps-close when finished. ")
 
-    sweep_filepath = path.join(project_dir,sweep_file)
-    finished_rfs = set(rf_status[Status.FINISHED])
-
-    params = []
-    results = []
-    script_ids = []
-    for rf in finished_rfs:
-        rf_path = path.join(project_dir,'rfs',rf)
-        if path.exists(rf_path):
-            with open(os.path.join(rf_path,'params.json')) as param_file:
-                params.append(json.load(param_file))
-
-            # pull all data files from run folder (RF)
-            tup = tuple([x for x in get_data(rf,project_dir)])
-            if len(tup) == 1: 
-                results.append(tup[0])
-            elif len(tup) == 0: 
-                warnings.warn("Data file was not produced by finished run: " + str(rf))
-            else: 
-                results.append(tup)
-            
-            # get script id
-            with open(path.join(project_dir,'rfs',rf,'status.txt'), 'r') as file:
-                for line in file:
-                    _, _, script_id = (s.strip() for s in line.split('|'))
-                script_ids.append(script_id)
+    if rf_status[Status.TIMEOUT]:
+        warnings.warn("Warning: Found rfs with status TIMEOUT.")
     
-    if np.unique(script_ids).size > 1: 
-        raise ValueError("Reading data produced by a multiple scripts.")
-
-    df = pd.DataFrame(params,index=finished_rfs)
-    df['results'] = pd.Series(results,index=df.index)
+    if rf_status[Status.RUNNING] or rf_status[Status.SPECULATIVE] or rf_status[Status.RETRYING]:
+        warnings.warn("Sweeps still running. Rerun sweeps-close when finished. ")
 
     # designate directory for combined run results and information
     params_id = get_param_id(project_dir,sweep_file)
     data_path = path.join(project_dir,'data',params_id)
-    if not path.exists(data_path):
-        os.mkdir(data_path)
-
-    # collect status file outputs and save to a master log file
-    with open(path.join(data_path,'status.txt'),'w+') as status_file:
-        for rf in rfs:
-            with open(path.join(project_dir,'rfs',rf,'status.txt'),'r') as infile:
-                for line in infile: pass
-            write(status_file,"Status for RF " + str(rf) +": " + str(line))
-    
-    # collect log file outputs and save to a master log file
-    with open(path.join(data_path,'log.txt'),'w+') as log_file:
-        for rf in rfs:
-            with open(path.join(project_dir,'rfs',rf,'log.txt'),'r') as infile:
-                write(log_file,"LOG FILE FOR RF: " + str(rf))
-                for line in infile: 
-                    log_file.write(line)
-
-    df.to_pickle(path.join(data_path,'result.pkl'))
+    results_path = path.join(data_path,'results')
+    manifest_path = path.join(data_path,'close.json')
+    if full or not path.exists(manifest_path):
+        if path.exists(data_path):
+            shutil.rmtree(data_path)
+        os.makedirs(results_path)
+        manifest = {'parts': 0, 'script_id': None, 'results': [], 'rfs': {}, 'arrays': {}}
+    else:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        manifest.setdefault('arrays', {})
+        # remove parts written by an interrupted close
+        for part in os.listdir(results_path):
+            if int(part[5:10]) >= manifest['parts']:
+                os.remove(path.join(results_path,part))
+
+    # rfs run again since they were collected are collected anew, their old
+    # rows dropped from the parts holding them
+    updates = collect_rf_updates(project_dir)
+    stale = {rf for rf in manifest['results']
+        if manifest['rfs'].get(rf, {}).get('updates') != updates.get(rf, 0)}
+    if stale:
+        drop_rows(data_path, stale)
+        manifest['results'] = [rf for rf in manifest['results'] if rf not in stale]
+        if not manifest['results']:
+            manifest['script_id'] = None
+    ingested = set(manifest['results'])
+    finished_rfs = sorted(rf for rf in rf_status[Status.FINISHED] if rf not in ingested)
+
+    script_ids = {manifest['script_id']} - {None}
+    new_params = []
+    parameter_keys, parameter_values = read_axes(sweep_filepath)
+    rounds = None
+    if 'adaptive' in read_options(sweep_filepath):
+        rounds = {}
+        for number, points in enumerate(read_rounds(sweep_filepath)):
+            for point in points:
+                rounds.setdefault(point_rf(point), number)
+    grid = {}   # rf -> positions in the arrays
+    for position, (rf, _) in enumerate(read_sweep(sweep_filepath)):
+        grid.setdefault(rf, []).append(position)
+    with decoding_pool(procs) as pool:
+        for start in range(0, len(finished_rfs), chunk_size):
+            chunk = finished_rfs[start:start+chunk_size]
+            rows = [row for row in pool.map(load_rf, [project_dir]*len(chunk), chunk,\
+                chunksize=max(1, len(chunk) // (4 * (procs or os.cpu_count())))) if row]
+            for rf, _, results, script_id, _ in rows:
+                script_ids.add(script_id)
+            if len(script_ids) > 1:
+                raise ValueError("Reading data produced by a multiple scripts.")
+
+            # copy array results into the arrays of the sweep
+            copies = []
+            for rf, _, results, _, arrays in rows:
+                if results is None and not arrays:
+                    warnings.warn("Data file was not produced by finished run: " + str(rf))
+                for name, spec in arrays.items():
+                    if name not in manifest['arrays']:
+                        create_array(data_path, name, spec, parameter_keys, parameter_values)
+                        manifest['arrays'][name] = spec
+                    if manifest['arrays'][name] != spec:
+                        warnings.warn("Result " + name + " of rf " + rf + " differs in shape "
+                            "or dtype from other rfs: not collected")
+                        continue
+                    copies.append((rf, name))
+            list(pool.map(copy_array, [project_dir]*len(copies), [data_path]*len(copies),\
+                [rf for rf, _ in copies], [name for _, name in copies],\
+                [grid[rf] for rf, _ in copies]))
+            for name in {name for _, name in copies}:
+                filled = np.load(path.join(data_path,'arrays',name+'.filled.npy'), mmap_mode='r+')
+                filled.reshape(-1)[[p for rf, n in copies if n == name for p in grid[rf]]] = True
+                filled.flush()
+
+            df = pd.DataFrame([params for _, params, _, _, _ in rows],\
+                index=[rf for rf, _, _, _, _ in rows])
+            if rounds is not None:
+                df['_round'] = [rounds.get(rf) for rf in df.index]
+            df['results'] = pd.Series([results for _, _, results, _, _ in rows],\
+                index=df.index, dtype=object)
+            write_part(results_path, manifest['parts'], df)
+            new_params.append(df.drop(columns='results').assign(_part=manifest['parts']))
+            manifest['parts'] += 1
+            manifest['results'].extend(df.index)
+    manifest['script_id'] = next(iter(script_ids), None)
+
+    # index the parameters of all collected rfs and the part holding them
+    if new_params or stale:
+        params = read_params_index(data_path)
+        if params is not None:
+            old_parts = manifest['parts'] - len(new_params)
+            new_params.insert(0, params[(params['_part'] < old_parts)\
+                & ~params.index.isin(stale)])
+        for filename in os.listdir(data_path):
+            if filename.startswith('params.'):
+                os.remove(path.join(data_path,filename))
+        write_frame(path.join(data_path,'params'), pd.concat(new_params))
+
+    # only rfs whose status changed since the previous close have new
+    # status lines or log output
+    changed_rfs = [rf for rf in rfs if rf not in manifest['rfs']
+        or manifest['rfs'][rf]['updates'] != updates.get(rf, 0)]
+
+    # append new status file outputs and log file outputs to master files
+    with open(path.join(data_path,'status.txt'),'a') as status_file,\
+            open(path.join(data_path,LOG_FILE),'ab') as log_file,\
+            open(path.join(data_path,LOG_INDEX),'a') as log_index:
+        for rf in changed_rfs:
+            offsets = dict({'status': 0, 'log': 0, 'log_gz': 0}, **manifest['rfs'].get(rf, {}))
+            with open_rf_file(project_dir,rf,'status.txt') as infile:
+                infile.seek(offsets['status'])
+                lines = infile.readlines()
+                status_offset = infile.tell()
+            if lines or not offsets['status']:
+                line = lines[-1].decode() if lines else ""
+                write(status_file,"Status for RF " + str(rf) +": " + line)
+
+            write(log_index, rf + " " + str(log_file.tell()))
+            log_file.write(gzip.compress(("LOG FILE FOR RF: " + str(rf) + "\n").encode(),\
+                mtime=0))
+            log_gz_offset, log_offset = copy_log(project_dir, rf, log_file,\
+                offsets['log_gz'], offsets['log'])
+            manifest['rfs'][rf] = {'updates': updates.get(rf, 0),\
+                'status': status_offset, 'log': log_offset, 'log_gz': log_gz_offset}
+
+    if path.exists(path.join(data_path,'result.pkl')):
+        os.remove(path.join(data_path,'result.pkl'))    # superseded by results/
     shutil.copyfile(sweep_filepath,path.join(data_path,sweep_file))
+    if rounds is not None and path.exists(rounds_path(sweep_filepath)):
+        shutil.copyfile(rounds_path(sweep_filepath),\
+            path.join(data_path,path.basename(rounds_path(sweep_filepath))))
+    with open(manifest_path + '.tmp','w') as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def load_rf(project_dir, rf):
+    """
+    Return (rf, params, pickled results, script id, arrays) of a finished rf,
+    where results is the single data file or a tuple of all data files of the
+    rf, and arrays relates the name of each .npy result to its shape and
+    dtype.
+    """
+    rf_path = get_rf_path(project_dir,rf)
+    if not path.exists(rf_path) and rf not in read_packs(project_dir):
+        return None
+    with open_rf_file(project_dir,rf,'params.json','r') as param_file:
+        params = json.load(param_file)
+
+    # pull all data files from run folder (RF); .npy results are collected
+    # into arrays instead
+    filenames = result_files(project_dir, rf)
+    tup = tuple(get_data(rf, project_dir, arrays=False))
+    results = None if len(tup) == 0 else pickle.dumps(tup[0] if len(tup) == 1 else tup, -1)
+
+    arrays = {filename[:-4]: read_array_spec(project_dir, rf, filename[:-4])
+        for filename in filenames if filename.endswith('.npy')}
 
-def get_dataframe(project_dir,rf=None):
-    directory_list = os.listdir(os.path.join(project_dir,'data'))
-    if rf == None:
-        for param_folder in directory_list:
-            yield pd.read_pickle(os.path.join(project_dir,'data',param_folder,'result.pkl'))
-    else: 
-        yield pd.read_pickle(os.path.join(project_dir,'data',rf,'result.pkl'))
+    # get script id
+    with open_rf_file(project_dir,rf,'status.txt','r') as file:
+        for line in file:
+            _, _, script_id = (s.strip() for s in line.split('|'))
+    return rf, params, results, script_id, arrays
 
-def get_data(ID:str, sim_loc: str):
+def read_array_spec(project_dir, rf, name):
+    with open_rf_file(project_dir, rf, name + '.npy') as file:
+        shape, fortran_order, dtype = read_array_header(file)
+    return [list(shape), dtype.str + ('F' if fortran_order else '')]
+
+def load_array(project_dir, rf, name):
+    """
+    Return the .npy result name of rf without reading it into memory.
+    """
+    return load_file(project_dir, rf, name + '.npy', lazy=True)
+
+def create_array(data_path, name, spec, parameter_keys, parameter_values):
+    """
+    Create the array for result name of a sweep, with an axis per parameter
+    followed by the axes of the result, and a boolean array of the points
+    whose results have been copied.
     """
-    Return data extracted from a saved file in a particular run folder.
+    arrays_path = path.join(data_path,'arrays')
+    os.makedirs(arrays_path, exist_ok=True)
+    grid_shape = tuple(len(values) for values in parameter_values)
+    shape, dtype = spec
+    np.lib.format.open_memmap(path.join(arrays_path,name+'.npy'), mode='w+',\
+        dtype=np.dtype(dtype.rstrip('F')), shape=grid_shape + tuple(shape),\
+        fortran_order=False).flush()
+    np.lib.format.open_memmap(path.join(arrays_path,name+'.filled.npy'), mode='w+',\
+        dtype=bool, shape=grid_shape).flush()
+    with open(path.join(arrays_path,name+'.json'), 'w') as file:
+        json.dump({'axes': list(zip(parameter_keys, parameter_values)), 'shape': shape,\
+            'dtype': dtype}, file)
+
+def copy_array(project_dir, data_path, rf, name, positions):
+    source = load_array(project_dir, rf, name)
+    target = np.load(path.join(data_path,'arrays',name+'.npy'), mmap_mode='r+')
+    flat = target.reshape((-1,) + source.shape)
+    for position in positions:
+        flat[position] = source
+    target.flush()
+
+def get_array(project_dir, name='result', params_id=None):
+    """
+    Return the results name of a closed sweep, written by the rfs with
+    sweep_utils.write_result, as a read-only memory-mapped array with an axis
+    per parameter of the sweep followed by the axes of the results. Also
+    return a dictionary relating each parameter to its values along its axis,
+    and a boolean array of the points whose results have been collected.
+
+    params_id selects the closed sweep in project_dir/data; it may be
+    omitted if only one closed sweep has results name.
+    """
+    data_dir = path.join(project_dir,'data')
+    candidates = os.listdir(data_dir) if params_id is None else [params_id]
+    candidates = [folder for folder in candidates
+        if path.exists(path.join(data_dir,folder,'arrays',name+'.npy'))]
+    if len(candidates) != 1:
+        raise ValueError(("No" if not candidates else "More than one") + " closed sweep "
+            "with results " + name + (": give params_id" if candidates else ""))
+    arrays_path = path.join(data_dir,candidates[0],'arrays')
+    with open(path.join(arrays_path,name+'.json')) as file:
+        axes = dict((key, values) for key, values in json.load(file)['axes'])
+    return np.load(path.join(arrays_path,name+'.npy'), mmap_mode='r'), axes,\
+        np.load(path.join(arrays_path,name+'.filled.npy'), mmap_mode='r')
+
+def write_frame(name, df):
+    # parquet needs pyarrow (pip install pyarrow) and columns of one type
+    # (pyarrow's conversion errors subclass ValueError, TypeError and
+    # NotImplementedError); readers prefer a parquet file to a pickle
+    try:
+        df.to_parquet(name + '.parquet')
+    except (ImportError, ValueError, TypeError, NotImplementedError):
+        if path.exists(name + '.parquet'):
+            os.remove(name + '.parquet')
+        df.to_pickle(name + '.pkl')
+
+def read_frame(filepath, columns=None):
+    if filepath.endswith('.parquet'):
+        return pd.read_parquet(filepath, columns=columns)
+    df = pd.read_pickle(filepath)
+    return df if columns is None else df[columns]
+
+def write_part(results_path, part, df):
+    write_frame(path.join(results_path, "part-%05d" % part), df)
+
+def drop_rows(data_path, rfs):
+    """
+    Remove the rows of rfs from the parts of the results in data_path which
+    hold them, as found in the parameter index.
+    """
+    params = read_params_index(data_path)
+    if params is None:
+        return
+    results_path = path.join(data_path,'results')
+    for part in sorted(set(params.loc[params.index.isin(rfs), '_part'])):
+        filepath = find_part(results_path, part)
+        df = read_frame(filepath)
+        os.remove(filepath)
+        write_part(results_path, part, df[~df.index.isin(rfs)])
+
+def read_part(filepath):
+    df = read_frame(filepath)
+    df['results'] = df['results'].map(lambda b : None if b is None else pickle.loads(b))
+    return df
+
+def find_part(results_path, part):
+    for ext in ('.parquet', '.pkl'):
+        filepath = path.join(results_path, "part-%05d" % part + ext)
+        if path.exists(filepath):
+            return filepath
+
+def read_params_index(data_path):
+    for ext in ('.parquet', '.pkl'):
+        filepath = path.join(data_path, 'params' + ext)
+        if path.exists(filepath):
+            return read_frame(filepath)
+
+class LazyResult:
+    """
+    Stored result of an rf, only decoded when load() is called.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def load(self):
+        return None if self.data is None else pickle.loads(self.data)
+
+    def __repr__(self):
+        return "<LazyResult: " + str(len(self.data or b'')) + " bytes>"
+
+def select_results(project_dir, where=None, columns=None, params_id=None, chunked=False):
+    """
+    Yield a dataframe of the rfs of each closed sweep in project_dir/data (or
+    only of data/params_id) whose parameters satisfy where, a pandas query
+    expression such as "a == 1 and c < 40", restricted to the given columns.
+
+    Matching rfs are looked up in the parameter index written by close, so
+    only the parts of the results holding them are read, and not at all if
+    'results' is not among columns. Results are returned as LazyResult
+    objects. If chunked, yield one dataframe per part read instead.
+    """
+    data_dir = os.path.join(project_dir,'data')
+    directory_list = os.listdir(data_dir) if params_id is None else [params_id]
+    for param_folder in directory_list:
+        data_path = os.path.join(data_dir,param_folder)
+        params = read_params_index(data_path)
+        if params is None:
+            # closed without a parameter index: filter the whole dataframe
+            df = next(get_dataframe(project_dir,param_folder))
+            df = df.query(where) if where else df
+            df['results'] = df['results'].map(lambda r : LazyResult(pickle.dumps(r, -1)))
+            yield df if columns is None else df[columns]
+            continue
+
+        if where:
+            params = params.query(where)
+        if columns is not None and 'results' not in columns:
+            yield params[columns]
+            continue
+
+        frames = (select_part(path.join(data_path,'results'), part, rows.index, columns)
+            for part, rows in params.groupby('_part'))
+        if chunked:
+            yield from frames
+        else:
+            frames = list(frames)
+            yield pd.concat(frames) if frames else \
+                pd.DataFrame(columns=columns or [*params.columns.drop('_part'), 'results'])
+
+def select_part(results_path, part, rfs, columns=None):
+    df = read_frame(find_part(results_path, part), columns).loc[rfs]
+    df['results'] = df['results'].map(LazyResult)
+    return df
+
+def get_dataframe(project_dir,rf=None,chunked=False,workers=1):
+    """
+    Yield a dataframe of the results of each closed sweep in project_dir/data,
+    or only of data/rf if given. If chunked, yield one dataframe per part of
+    the results instead of concatenating them. Parts are read by workers
+    threads, each reading ahead at most one part.
+    """
+    directory_list = os.listdir(os.path.join(project_dir,'data')) if rf is None else [rf]
+    for param_folder in directory_list:
+        data_path = os.path.join(project_dir,'data',param_folder)
+        results_path = os.path.join(data_path,'results')
+        if not path.exists(results_path):
+            # closed before results were stored in parts
+            yield pd.read_pickle(os.path.join(data_path,'result.pkl'))
+            continue
+        parts = read_parts([path.join(results_path,part)
+            for part in sorted(os.listdir(results_path))], workers)
+        if chunked:
+            yield from parts
+        else:
+            parts = list(parts)
+            yield pd.concat(parts) if parts else pd.DataFrame(columns=['results'])
+
+def result_files(project_dir, rf):
+    # the files of rf which a loader is registered for
+    return [filename for filename in list_rf_files(project_dir, rf)
+        if filename not in RF_FILES and not filename.startswith('.')
+        and find_loader(filename) is not None]
+
+def read_parts(filepaths, workers=1):
+    if workers == 1:
+        yield from map(read_part, filepaths)
+        return
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for start in range(0, len(filepaths), workers):
+            yield from pool.map(read_part, filepaths[start:start+workers])
+
+def get_data(ID:str, sim_loc: str, lazy=False, arrays=True):
+    """
+    Return data extracted from the saved files in a particular run folder,
+    decoded by the loaders registered for them (see
+    sweep_loaders.register_loader).
 
     Keyword arguments:
     ID -- hash / folder name of desired run
     sim_loc -- location of where sweeps was run and ./rfs/ folder is located
+    lazy -- return lazy or memory-mapped handles, e.g. open h5py files, for
+            files whose loaders support it; these are closed by the caller
+    arrays -- also return .npy results, which close collects into arrays
+              rather than into the results column
+    """
+    for filename in result_files(sim_loc, ID):
+        if arrays or not filename.endswith('.npy'):
+            yield load_file(sim_loc, ID, filename, lazy)
+
+def load_results(project_dir, rfs, workers=None, lazy=False, arrays=True):
+    """
+    Yield (rf, data) for each rf in rfs in order, where data is the tuple of
+    the data files of rf (see get_data), decoded by workers processes at a
+    time. Lazy handles cannot leave the process which opened them, so if
+    lazy, files are opened by workers threads instead.
     """
-    directory_list = os.listdir(os.path.join(sim_loc,'rfs',ID))
-    directory_list = [e for e in directory_list if e not in (
-        'log.txt', 'params.json', 'status.txt')]
-
-    for filename in directory_list:
-        if filename[0] == '.':
-            # Hidden file - exclude from search
-            directory_list.remove(filename)
-            break
-        filepath = os.path.join(sim_loc,'rfs',ID,filename)
-        if filename[-5:] == '.hdf5':
-            # HDF5 file
-            import h5py
-            with h5py.File(filepath, 'r') as f:
-                print("Keys: %s" % f.keys())    # List all groups
-                yield f
-        elif filename[-4:] == '.mat':
-            # Matlab matrix file
-            import scipy.io
-            yield scipy.io.loadmat(filepath)
-        elif filename[-5:] == '.json' and filename != 'params.json':
-            with open(filepath) as data_file:
-                yield json.load(data_file)
-        elif filename[-5:] == '.bson':
-            # Binary JSON file
-            import bson     # bson neds to be installed: pip install bson
-            with open(filepath) as bson_file:
-                yield bson.loads(bson_file.read())
-        elif filename[-4:] == '.npz':
-            # Numpy npz file
-            yield np.load(filepath)
-        elif filename[-5:] == '.pklz':
-            # pickle file
-            import pickle
-            import gzip
-            with gzip.open(filepath) as f:
-                yield pickle.load(f)
-        elif filename[-4:] == '.pkl':
-            yield pd.read_pickle(filepath)
-        elif filename[-4:] == '.jld' or filename[-5:] == '.jld2':
-            # Julia JLD or JLD2 file, which uses HDF5 encoding
-            # Return an appropriate numpy matrix if
-            import h5py
-            with h5py.File(filepath, 'r') as f:
-                keys = f.keys()
-                yield(
-                    f if len(keys) > 1
-                    else np.transpose(np.array(f.get(list(keys)[0])))
-                    # Note: Julia stores data in column major order, as opposed
-                    # to row major used by numpy, so to read matrices this way
-                    # they are transposed.
-                )
+    rfs = list(rfs)
+    with (concurrent.futures.ThreadPoolExecutor(workers) if lazy else\
+            decoding_pool(workers)) as pool:
+        yield from zip(rfs, pool.map(load_data, [project_dir]*len(rfs), rfs,\
+            [lazy]*len(rfs), [arrays]*len(rfs), chunksize=1 if lazy else 16))
+
+def decoding_pool(workers=None):
+    # a pool of processes with the loaders of this one, which they do not
+    # inherit when started by spawn or forkserver
+    return concurrent.futures.ProcessPoolExecutor(workers, initializer=install_loaders,\
+        initargs=(shared_loaders(),))
+
+def load_data(project_dir, rf, lazy=False, arrays=True):
+    return tuple(get_data(rf, project_dir, lazy, arrays))
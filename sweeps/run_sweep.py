@@ -1,26 +1,68 @@
 import argparse
 import os, os.path as path, shutil
 import signal
-import subprocess, multiprocessing
+import sys
+import subprocess
+import asyncio
+import collections
+import math
+import time
+import random
+import socket
+import threading
 
-from .sweep_utils import get_timestamp, asheader, write, get_script_id
-from .sweep_utils import Status, collect_rf_status, generate_status
-from .setup_sweep import read_sweep
+from .sweep_utils import get_timestamp, asheader, write, get_script_id, write_usage
+from .sweep_utils import Status, collect_rf_status, collect_rf_updates, write_status, read_status
+from .sweep_utils import ACTIVE, get_rf_path, index_writer
+from .setup_sweep import read_sweep, read_options, unpack_rfs
+from .sweep_stats import predict_usage
+from .sweep_cache import CACHE_DIR, ResultCache, detach_rf, result_files
+from .sweep_log import LOG_FILE, LOG_LIMIT, LogWriter, OutputPipe, start_log, write_log,\
+    forward_output
 
-def run_sweep(project_dir, prog, script_file, num_procs, sweep_file=None, rerun_failed=False):
+TIMED_OUT = "TIMEOUT"   # exit code of runs killed for running out of time
+KILL_GRACE = 10         # seconds between terminating and killing a run
+SPECULATE_MIN = 5       # finished runs needed to estimate percentiles
+
+def run_sweep(project_dir, prog, script_file, num_procs, sweep_file=None, rerun_failed=False,
+        warm=None, recycle=100, batch=None, batch_time=60, lease=None, longest_first=False,
+        memory=None, cache=False, depends=(), cache_size=10240, timeout=None,
+        sweep_timeout=None, retry=(), retries=3, backoff=10, speculate=None,
+        log_limit=LOG_LIMIT):
     timestamp = get_timestamp()
-    # Determine status of all requested rfs
-    rf_status = collect_rf_status(project_dir,script=script_file)
+    deadline = time.time() + sweep_timeout if sweep_timeout is not None else None
+    if lease is not None:
+        # several hosts may start a sweep at the same time
+        timestamp += "_" + socket.gethostname() + "-" + str(os.getpid())
+    # Determine status of all requested rfs; distributed sweeps leave the
+    # index to the other commands (see sweep_utils.JOURNALS_DIR)
+    rf_status = collect_rf_status(project_dir,script=script_file,merge=lease is None)
 
+    options = {}
     if sweep_file is not None:
         sweep_filepath = path.join(project_dir,sweep_file)
         rfs = [rf for rf,_ in read_sweep(sweep_filepath)]
         for status in Status:
             rf_status[status].intersection_update(rfs)
+        options = read_options(sweep_filepath)
+    if timeout is None:
+        timeout = options.get('timeout')
 
     queued_rfs = set(rf_status[Status.NEW])
     if rerun_failed:
-        queued_rfs.update(rf_status[Status.FAILED])
+        queued_rfs.update(rf_status[Status.FAILED], rf_status[Status.TIMEOUT])
+    if lease is not None:
+        # rfs of dead hosts are taken over once their claims expire
+        queued_rfs.update(*(rf_status[status] for status in ACTIVE))
+
+    # packed rfs are run in folders again
+    unpack_rfs(project_dir, queued_rfs)
+
+    # Predict the cost of the rfs to order them or keep within memory
+    costs = None
+    if longest_first or memory is not None:
+        costs = predict_usage(project_dir, script_file, queued_rfs, options.get('cost'),
+            merge=lease is None)
 
     # Write summary of rfs status to file
     run = timestamp+'.run'
@@ -39,91 +81,873 @@ def run_sweep(project_dir, prog, script_file, num_procs, sweep_file=None, rerun_
         for rf in sorted(rf_status[Status.INVALID]):
             write(file, "## " + rf)
         write(file, asheader("REQUESTED RFs QUEUED OR RUNNING", "### "))
-        for rf in sorted(rf_status[Status.QUEUED]):
-            write(file, "### " + rf)
-        for rf in sorted(rf_status[Status.RUNNING]):
-            write(file, "### " + rf)
+        for status in ACTIVE:
+            for rf in sorted(rf_status[status]):
+                write(file, "### " + rf)
 
     if rf_status[Status.INVALID]:
         print("Warning: Found rfs with status INVALID (ignored)")
-    if rf_status[Status.RUNNING] or rf_status[Status.QUEUED]:
+    if lease is None and any(rf_status[status] for status in ACTIVE):
         print("Warning: Found rfs with status QUEUED or RUNNING (ignored)")
 
+    # Copy to history
+    os.rename(run_file, path.join(project_dir,'history',run))
+    if sweep_file is not None:
+        if lease is None:
+            os.rename(sweep_filepath, path.join(project_dir,'history',sweep_file))
+        else:
+            shutil.copyfile(sweep_filepath, path.join(project_dir,'history',sweep_file))
+    shutil.copyfile(path.join(project_dir,script_file),\
+        path.join(project_dir,'history',timestamp+'.script'))
+
+    result_cache = ResultCache(project_dir, prog, script_file, depends, cache_size)\
+        if cache else None
+
+    # Start the sweep and wait for it to finish or quit
+    print("Sweep started. Press CTRL+C to interrupt.")
+    try:
+        with index_writer(project_dir, journal=lease is not None):
+            if lease is None:
+                write_status(project_dir, queued_rfs, "  QUEUED", script_id)
+            asyncio.run(schedule(project_dir, prog, script_file, script_id, queued_rfs,
+                num_procs, warm, recycle, batch, batch_time, lease, rerun_failed, costs, memory,
+                result_cache, timeout, deadline, set(retry), retries, backoff, speculate,
+                log_limit))
+    finally:
+        if result_cache is not None:
+            print(result_cache.report())
+    print("Sweep completed.")
+
+async def schedule(project_dir, prog, script_file, script_id, queued_rfs, num_procs,
+        warm=None, recycle=100, batch=None, batch_time=60, lease=None, rerun_failed=False,
+        costs=None, memory=None, cache=None, timeout=None, deadline=None, retry=(),
+        retries=3, backoff=10, speculate=None, log_limit=LOG_LIMIT):
+    """
+    Run the queued rfs on a single event loop, at most num_procs at a time.
+    If warm names an entry function of a Python script, each slot keeps a
+    worker importing the script once and calling warm(rf_path) per rf; a
+    worker is replaced after recycle runs or when it crashes. Otherwise, if
+    batch is given, each invocation of the script receives up to batch rfs,
+    sized so that a batch takes about batch_time seconds (see run_batch).
+
+    If a lease is given, the rfs are shared with sweeps on other hosts: each
+    rf is claimed (see claim_rf) and marked QUEUED only when it is taken to
+    be run, and claims are renewed until they are released after the run.
+
+    If costs relate rfs to their predicted wall time and peak memory in MB,
+    the rfs are run longest first, and if memory is given, rfs are only
+    started while the predicted memory of all running processes stays
+    within memory MB, smaller rfs being started first if the next do not
+    fit. An rf which does not fit at all is run on its own.
+
+    If a ResultCache is given, rfs found in it are satisfied from the cache
+    instead of being run, and the results of finished rfs are added to it.
+
+    Runs are terminated after timeout seconds and marked TIMEOUT, as are the
+    runs still going at deadline, a time.time() after which no rfs are
+    started; the rfs left are marked NEW again. Runs of single rfs failing
+    with an exit code in retry (minus the signal for runs killed by one) are
+    marked RETRYING and run again after a random backoff of up to backoff
+    seconds, doubled for every retry, at most retries times. If speculate
+    gives a percentile, rfs run without warm or batch which have been
+    running longer than that percentile of the wall times of the runs
+    finished so far are run a second time once no rfs are left to start,
+    and marked SPECULATIVE (see speculate_rf).
+
+    The output of runs is captured through pipes into the compressed logs of
+    the rfs, keeping the first and last log_limit/2 bytes of each run (see
+    sweep_log.LogWriter); a log_limit of 0 keeps all output.
+    """
+    loop = asyncio.get_running_loop()
+    pending = collections.deque(sorted(queued_rfs))
+    if costs is not None:
+        pending = collections.deque(sorted(pending, key=lambda rf: -costs[rf][0]))
+    processes = {}
+    interrupted = None
+    error = None        # the first error of a worker, which stops the sweep
+    run_time = None     # moving average of the time per rf in a batch
+    claimed, held = set(), set()
+    reserved = 0        # predicted memory of the running processes
+    linked = path.isdir(path.join(project_dir, CACHE_DIR))
+    changed = asyncio.Condition()   # notified when memory is freed or rfs requeued
+    attempts = collections.Counter()
+    delayed = set()     # rfs waiting to be retried
+    running = {}        # rf -> start of its run, for speculation
+    walls = []          # wall times of the runs finished
+    backups, speculated = {}, set()
+    if lease is not None:
+        if costs is None:
+            random.shuffle(pending)     # spread hosts over the rfs
+        updates = collect_rf_updates(project_dir, merge=False)
+
+    def take(n):
+        """
+        Take up to n rfs to run in one process from pending, and reserve
+        their memory; returns the rfs and the memory reserved.
+        """
+        nonlocal reserved
+        rfs, need, index = [], 0, 0
+        while index < min(len(pending), 100) and len(rfs) < n:
+            rf = pending[index]
+            rf_need = max(need, costs[rf][1]) if costs is not None else 0
+            if memory is not None and reserved + rf_need > memory and (rfs or reserved):
+                index += 1
+                continue
+            del pending[index]
+            if lease is None or rf in held:
+                rfs.append(rf)
+                need = rf_need
+                continue
+            reclaimed = claim_rf(project_dir, rf, lease)
+            if reclaimed is None:
+                continue
+            if queue_claimed(project_dir, rf, script_id, reclaimed, rerun_failed,\
+                    updates.get(rf, 0)):
+                claimed.add(rf)
+                held.add(rf)
+                rfs.append(rf)
+                need = rf_need
+            else:
+                release_rf(project_dir, rf)
+        reserved += need
+        return rfs, need
+
+    async def notify():
+        async with changed:
+            changed.notify_all()
+
+    async def free(need):
+        nonlocal reserved
+        reserved -= need
+        await notify()
+
+    def release(rfs):
+        for rf in held.intersection(rfs):
+            held.remove(rf)
+            release_rf(project_dir, rf)
+
+    def store(rfs):
+        if cache is None:
+            return
+        for rf in rfs:
+            if read_status(rf, project_dir, script_id)[0] is Status.FINISHED:
+                cache.store(rf)
+
+    def retrying(rf, rc):
+        return rc in retry and attempts[rf] < retries and rf not in speculated
+
+    def requeue(rf):
+        delayed.discard(rf)
+        pending.appendleft(rf)
+        asyncio.ensure_future(notify())
+
+    def expired():
+        return deadline is not None and time.time() >= deadline
+
+    def straggler():
+        """
+        Return the rf running longest if it has run longer than the speculate
+        percentile of the wall times, and otherwise the seconds until it may,
+        inf if it may once more runs finished, or None if there is none.
+        """
+        candidates = {rf: start for rf, start in running.items() if rf not in speculated}
+        if speculate is None or not candidates:
+            return None, None
+        if len(walls) < SPECULATE_MIN:
+            return None, math.inf
+        threshold = sorted(walls)[min(len(walls) - 1, int(len(walls) * speculate / 100))]
+        rf = min(candidates, key=candidates.get)
+        wait = candidates[rf] + threshold - time.time()
+        return (rf, 0) if wait <= 0 else (None, wait)
+
+    async def heartbeat():
+        # a claim which cannot be renewed only stops its own rf; any other
+        # error stops the sweep, as one of a worker would
+        nonlocal error
+        try:
+            while True:
+                await asyncio.sleep(lease / 4)
+                for rf in list(held):
+                    try:
+                        if renew_rf(project_dir, rf):
+                            continue
+                    except OSError as renew_error:
+                        print("Warning: Could not renew the claim of rf " + rf + ": "\
+                            + str(renew_error))
+                        continue
+                    # the claim expired and was taken over by another sweep
+                    held.discard(rf)
+                    if rf in processes:
+                        write_log(get_rf_path(project_dir,rf), "CLAIM LOST: TERMINATING SCRIPT")
+                        terminate_group(processes[rf])
+        except Exception as heartbeat_error:
+            error = error or heartbeat_error
+            print("Sweep failed: Terminating processes.")
+            stop("SWEEP FAILED: TERMINATING SCRIPT")
+
     # Define signal handlers
-    def handle_signal(rc, *args):
+    def handle_signal(rc):
+        nonlocal interrupted
         if rc == signal.SIGINT:
             print("\nSweep interrupted", end="")
         else:
             print("Sweep received external SIGNAL "+str(rc), end="")
         print(": Terminating processes.")
-        pool.terminate()
-        pool.join()
-        for rf in queued_rfs:
-            with open(path.join(project_dir,'rfs',rf,'status.txt'), 'a') as status:
-                write(status, generate_status("  KILLED",script_id))
-        raise SystemExit(rc)
+        interrupted = rc
+        stop("SIGNAL "+str(rc)+" RECEIVED: TERMINATING SCRIPT")
 
-    signal.signal(signal.SIGQUIT, handle_signal)
-    signal.signal(signal.SIGTERM, handle_signal)
-    signal.signal(signal.SIGINT, handle_signal)
+    def stop(message):
+        # terminate the runs going on, which workers then record as usual
+        for rf, process in processes.items():
+            write_log(get_rf_path(project_dir,rf), message)
+            terminate_group(process)
+        for backup in backups.values():
+            terminate_group(backup['process'])
+        asyncio.ensure_future(notify())
 
-    # Copy to history
-    os.rename(run_file, path.join(project_dir,'history',run))
-    if sweep_file is not None:
-        os.rename(sweep_filepath, path.join(project_dir,'history',sweep_file))
-    shutil.copyfile(path.join(project_dir,script_file),\
-        path.join(project_dir,'history',timestamp+'.script'))
+    for signum in (signal.SIGQUIT, signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, handle_signal, signum)
 
-    for rf in queued_rfs:
-        with open(path.join(project_dir,'rfs',rf,'status.txt'), 'a') as status:
-            write(status, generate_status("  QUEUED",script_id))
+    async def guarded():
+        """
+        Run a worker; an error of the worker stops the sweep as a signal
+        would, its own runs failing, and is raised once the other workers
+        have recorded theirs.
+        """
+        nonlocal error
+        slot = dict(rfs=[], warm=None)  # the rfs of the worker, and its warm worker
+        try:
+            await worker(slot)
+        except Exception as worker_error:
+            error = error or worker_error
+            print("Sweep failed: Terminating processes.")
+            stop("SWEEP FAILED: TERMINATING SCRIPT")
+            if slot['warm'] is not None:
+                terminate_group(slot['warm'])
+                await stop_worker(slot['warm'])
+            for rf in slot['rfs']:
+                if read_status(rf, project_dir, script_id)[0] in\
+                        (Status.RUNNING, Status.SPECULATIVE):
+                    write_log(get_rf_path(project_dir,rf), "SWEEP FAILED: RUN ABANDONED")
+                    write_status(project_dir, [rf], "  FAILED", script_id)
 
-    # Start the sweep
-    pool = multiprocessing.Pool(processes=num_procs)
-    args = [(project_dir, prog, script_file, rf) for rf in queued_rfs]
-    pool.imap_unordered(run_rf, args, chunksize=1)
-    pool.close()
+    async def worker(slot):
+        nonlocal run_time
+        runs = 0
+        while interrupted is None and error is None and not expired():
+            slot['rfs'] = []
+            if not pending:
+                # retry or speculate while other rfs are still running
+                rf, wait = straggler()
+                if rf is not None:
+                    slot['rfs'] = [rf]
+                    speculated.add(rf)
+                    await speculate_rf(project_dir, prog, script_file, rf, script_id,\
+                        processes, backups, timeout, deadline, log_limit)
+                    if rf not in backups and rf not in running:
+                        store([rf])
+                        release([rf])
+                    await notify()
+                    continue
+                if not delayed and wait is None:
+                    break
+                if deadline is not None:
+                    wait = min(wait or math.inf, deadline - time.time())
+                async with changed:
+                    try:
+                        await asyncio.wait_for(changed.wait(),\
+                            None if wait in (None, math.inf) else wait)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            size = batch_size(batch, batch_time, run_time, len(pending), num_procs)\
+                if batch is not None and warm is None else 1
+            rfs, need = take(size)
+            slot['rfs'] = rfs
+            if not rfs:
+                if pending and reserved:
+                    # wait for memory to run the next rfs
+                    async with changed:
+                        await changed.wait()
+                continue
+            if cache is not None:
+                restored = [rf for rf in rfs if restore_rf(project_dir, rf, script_id, cache)]
+                release(restored)
+                rfs = [rf for rf in rfs if rf not in restored]
+                if not rfs:
+                    await free(need)
+                    continue
+            if linked:
+                # results linked from the cache must not be overwritten in place
+                for rf in rfs:
+                    detach_rf(get_rf_path(project_dir, rf))
+            if batch is not None and warm is None:
+                start = time.time()
+                requeued = await run_batch(project_dir, prog, script_file, rfs, script_id,\
+                    processes, timeout, deadline, log_limit)
+                await free(need)
+                store(set(rfs).difference(requeued))
+                release(set(rfs).difference(requeued))
+                pending.extend(requeued)
+                if len(requeued) < len(rfs):
+                    elapsed = (time.time() - start) / (len(rfs) - len(requeued))
+                    run_time = elapsed if run_time is None else (run_time + elapsed) / 2
+                continue
+            rf, = rfs
+            if warm is None:
+                start = running[rf] = time.time()
+                try:
+                    rc = await run_rf(project_dir, prog, script_file, rf, script_id,\
+                        processes, timeout, deadline, retrying, backups, log_limit)
+                finally:
+                    del running[rf]
+                if rc == 0 and rf not in speculated:
+                    walls.append(time.time() - start)
+            else:
+                if slot['warm'] is None:
+                    slot['warm'], runs = await start_worker(prog, project_dir, script_file,\
+                        warm), 0
+                rc, alive = await run_rf_warm(project_dir, rf, script_id, slot['warm'],\
+                    processes, timeout, deadline, retrying, log_limit)
+                runs += 1
+                if not alive or runs >= recycle:
+                    await stop_worker(slot['warm'])
+                    slot['warm'] = None
+            if retrying(rf, rc):
+                attempts[rf] += 1
+                delayed.add(rf)
+                loop.call_later(random.uniform(0.5, 1) * backoff * 2**(attempts[rf] - 1),\
+                    requeue, rf)
+            elif rf not in backups:
+                store([rf])
+                release([rf])
+            await free(need)
+        if slot['warm'] is not None:
+            await stop_worker(slot['warm'])
+            slot['warm'] = None
 
-    # Wait for sweep to finish or quit
-    print("Sweep started. Press CTRL+C to interrupt.")
-    pool.join()
-    print("Sweep completed.")
+    raise_fd_limit()
+    renewing = asyncio.ensure_future(heartbeat()) if lease is not None else None
+    try:
+        await asyncio.gather(*(guarded() for _ in range(num_procs)))
+    finally:
+        if renewing is not None:
+            renewing.cancel()
+
+    if interrupted is not None or error is not None:
+        write_status(project_dir, queued_rfs if lease is None else held, "  KILLED",\
+            script_id)
+        release(list(held))
+        if error is not None:
+            raise error
+        raise SystemExit(interrupted)
+    left = [rf for rf in set(pending) | delayed if lease is None or rf in held]
+    if left:
+        print("Sweep timed out: " + str(len(left)) + " rfs not run.")
+        write_status(project_dir, left, "  KILLED", script_id)
+        release(left)
 
-def run_rf(args):
-    project_dir, prog, script_file, rf = args
-    rf_path = path.join(project_dir, 'rfs', rf)
+async def run_rf(project_dir, prog, script_file, rf, script_id, processes={}, timeout=None,
+        deadline=None, retrying=None, backups={}, log_limit=LOG_LIMIT):
+    """
+    Run rf and return its exit code, TIMED_OUT if it ran out of time (see
+    schedule). If rf was duplicated meanwhile, the first of the runs to
+    succeed is kept (see speculate_rf).
+    """
+    rf_path = get_rf_path(project_dir, rf)
     script_path = path.join(project_dir, script_file)
-    script_id = get_script_id(script_file, project_dir)
 
-    # Open log and status files
-    log = open(path.join(rf_path,'log.txt'), 'a')
-    status = open(path.join(rf_path,'status.txt'), 'a')
-    write(log, asheader("LOG FILE OPENED "+get_timestamp()))
+    # Run the script with its output piped into the log, in a session of its
+    # own so that CTRL+C reaches only the sweep, which terminates its runs
+    # itself (preexec_fn would rule out the fast vfork spawn of the child)
+    start_log(rf_path)
+    log = LogWriter(rf_path, log_limit)
+    output = OutputPipe(log.write)
+    start = time.time()
+    try:
+        process = subprocess.Popen([prog, script_path, rf_path],\
+            stdout=output.write_fd, stderr=subprocess.STDOUT, start_new_session=True)
+    finally:
+        output.detach()
+    processes[rf] = process
+    write_status(project_dir, [rf], " STARTED", script_id)
+    try:
+        rc, rusage, timed_out = await wait_timeout(process,\
+            time_left(start, timeout, deadline))
+    finally:
+        del processes[rf]
+        terminate_group(process)    # if not reaped, on errors
+        await output.wait_closed()
+        output_bytes, dropped_bytes = log.close()
+
+    rc = TIMED_OUT if timed_out else rc
+    usage = dict(start=start, wall=time.time()-start, **rusage_usage(rusage),\
+        output_bytes=output_bytes, dropped_bytes=dropped_bytes)
+    backup = backups.get(rf)
+    if backup is not None:
+        if backup['settled'] or rc != 0:
+            if backup['settled']:
+                del backups[rf]
+                message = "TERMINATED: SPECULATIVE RUN FINISHED FIRST"
+            else:
+                backup['abandoned'] = True
+                message = "SCRIPT RETURNED WITH EXIT CODE "+str(rc)+": LEFT TO SPECULATIVE RUN"
+            write_usage(project_dir, rf, dict(script_id=script_id, rc=rc, **usage))
+            write_log(rf_path, message)
+            return rc
+        backup['settled'] = True
+        backup['process'].terminate()
+    finish_rf(project_dir, rf, script_id, rc, usage, retrying is not None and retrying(rf, rc))
+    return rc
 
-    # Define signal handlers
-    def handle_signal(rc, *args):
-        write(log, "SIGNAL "+str(rc)+" RECEIVED: TERMINATING SCRIPT")
-        process.terminate()
-        raise SystemExit(rc)
-
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    signal.signal(signal.SIGTERM, handle_signal)
-
-    # Run the script
-    process = subprocess.Popen([prog, script_path, rf_path],\
-        stdout=log, stderr=subprocess.STDOUT)
-    write(status, generate_status(" STARTED",script_id))
-    try:
-        rc = process.wait()
-    except SystemExit as e:
-        rc = e.code
-        raise e
+async def speculate_rf(project_dir, prog, script_file, rf, script_id, processes, backups,
+        timeout=None, deadline=None, log_limit=LOG_LIMIT):
+    """
+    Run the running rf a second time, in a hidden copy of its folder with
+    its parameters, and mark it SPECULATIVE. The first run to succeed is
+    kept and the other one terminated; if both fail, the later one is kept.
+    The results of a kept duplicate are moved into the folder of rf, and its
+    output appended to the log of rf.
+    """
+    rf_path = get_rf_path(project_dir, rf)
+    backup_path = path.join(path.dirname(rf_path), '.'+rf+'.backup')
+    shutil.rmtree(backup_path, ignore_errors=True)
+    os.mkdir(backup_path)
+    shutil.copyfile(path.join(rf_path,'params.json'), path.join(backup_path,'params.json'))
+    write_log(rf_path, "RUN SLOWER THAN USUAL: SPECULATIVE RUN STARTED")
+    log = LogWriter(backup_path, log_limit)
+    output = OutputPipe(log.write)
+    start = time.time()
+    try:
+        process = subprocess.Popen([prog, path.join(project_dir, script_file), backup_path],\
+            stdout=output.write_fd, stderr=subprocess.STDOUT, start_new_session=True)
     finally:
-        if rc == 0:
-            write(status, generate_status("FINISHED",script_id))
+        output.detach()
+    backup = backups[rf] = dict(process=process, settled=False, abandoned=False)
+    write_status(project_dir, [rf], "SPECULAT", script_id)
+    try:
+        try:
+            rc, rusage, timed_out = await wait_timeout(process,\
+                time_left(start, timeout, deadline))
+        finally:
+            terminate_group(process)
+            await output.wait_closed()
+            size, dropped = log.close()
+        if backup['settled'] or (rc != 0 and not backup['abandoned']):
+            # the first run succeeded, or still may
+            del backups[rf]
+            return
+        for relative in result_files(backup_path):
+            os.makedirs(path.dirname(path.join(rf_path, relative)), exist_ok=True)
+            os.replace(path.join(backup_path, relative), path.join(rf_path, relative))
+        write_log(rf_path, asheader("SPECULATIVE RUN OUTPUT"))
+        with open(path.join(backup_path, LOG_FILE), 'rb') as backup_log,\
+                open(path.join(rf_path, LOG_FILE), 'ab') as rf_log:
+            shutil.copyfileobj(backup_log, rf_log)
+        if backup['abandoned']:
+            del backups[rf]
         else:
-            write(log, "SCRIPT RETURNED WITH EXIT CODE "+str(rc))
-            write(status, generate_status("  FAILED",script_id))
-        write(log, asheader("LOG FILE CLOSED "+get_timestamp()))
+            # the first run finds rf settled once it is terminated
+            backup['settled'] = True
+            processes[rf].terminate()
+        usage = dict(start=start, wall=time.time()-start, **rusage_usage(rusage),\
+            output_bytes=size, dropped_bytes=dropped, speculative=True)
+        finish_rf(project_dir, rf, script_id, TIMED_OUT if timed_out else rc, usage)
+    finally:
+        shutil.rmtree(backup_path, ignore_errors=True)
+
+async def run_rf_warm(project_dir, rf, script_id, worker, processes={}, timeout=None,
+        deadline=None, retrying=None, log_limit=LOG_LIMIT):
+    """
+    Run rf on a warm worker; returns the exit code of the run and whether the
+    worker is still alive. A worker running out of time is terminated. The
+    output of the worker is logged in the log of rf during the run.
+    """
+    rf_path = get_rf_path(project_dir, rf)
+    start_log(rf_path)
+    log = LogWriter(rf_path, log_limit)
+    worker.output.sink = log.write
+    start = time.time()
+
+    worker.stdin.write((path.abspath(rf_path)+'\n').encode())
+    processes[rf] = worker
+    write_status(project_dir, [rf], " STARTED", script_id)
+    timed_out = False
+    try:
+        await worker.stdin.drain()
+        line = await asyncio.wait_for(worker.stdout.readline(),\
+            time_left(start, timeout, deadline))
+    except ConnectionError:
+        line = b''
+    except asyncio.TimeoutError:
+        line, timed_out = b'', True
+        worker.terminate()
+        try:
+            await asyncio.wait_for(worker.wait(), KILL_GRACE)
+        except asyncio.TimeoutError:
+            worker.kill()
+    finally:
+        del processes[rf]
+        # the output of the run was written before its report
+        worker.output.read(drain=True)
+        worker.output.sink = forward_output
+        output_bytes, dropped_bytes = log.close()
+
+    usage = dict(start=start, wall=time.time()-start, user=None, sys=None, maxrss_kb=None,\
+        output_bytes=output_bytes, dropped_bytes=dropped_bytes)
+    if line:
+        # exit code, CPU times of the run and peak memory of the worker
+        rc, user, system, maxrss_kb = line.split()
+        rc = int(rc)
+        usage.update(user=float(user), sys=float(system), maxrss_kb=int(maxrss_kb))
+    else:
+        # the worker died during the run
+        rc = await worker.wait() or "WORKER EXITED"
+        rc = TIMED_OUT if timed_out else rc
+    finish_rf(project_dir, rf, script_id, rc, usage, retrying is not None and retrying(rf, rc))
+    return rc, bool(line)
+
+async def run_batch(project_dir, prog, script_file, rfs, script_id, processes={}, timeout=None,
+        deadline=None, log_limit=LOG_LIMIT):
+    """
+    Run the batch rfs in a single invocation of SCRIPT, which receives the
+    paths of all rfs as arguments. After finishing each rf, the script
+    reports it by appending a line "RF_PATH EXIT_CODE" to the file named by
+    the environment variable SWEEPS_BATCH_STATUS; rfs are marked STARTED in
+    order as the previous ones are reported. The output of the batch is
+    logged in the log of the first rf; only the wall time of each rf is
+    recorded in its usage.txt.
+
+    If the script exits before reporting every rf, the first unreported rf
+    is marked FAILED and the remaining ones are returned to be requeued. If
+    the rf being run runs out of time (see schedule), the batch is
+    terminated and the rf marked TIMEOUT instead. Report lines which are not
+    of an rf of the batch are logged with its output and ignored.
+    """
+    rf_paths = [get_rf_path(project_dir, rf) for rf in rfs]
+    report_path = path.join(project_dir, 'rfs', '.batch-'+rfs[0])
+    open(report_path, 'w').close()
+    for rf_path in rf_paths[1:]:
+        start_log(rf_path)
+        write_log(rf_path, "OUTPUT OF BATCH LOGGED IN RF "+rfs[0])
+
+    start_log(rf_paths[0])
+    write_log(rf_paths[0], "BATCH OF "+str(len(rfs))+" RFs: "+" ".join(rfs))
+    log = LogWriter(rf_paths[0], log_limit)
+    output = OutputPipe(log.write)
+    try:
+        process = subprocess.Popen([prog, path.join(project_dir, script_file)] + rf_paths,\
+            stdout=output.write_fd, stderr=subprocess.STDOUT, start_new_session=True,\
+            env=dict(os.environ, SWEEPS_BATCH_STATUS=report_path))
+    finally:
+        output.detach()
+    processes[rfs[0]] = process
+
+    unreported = collections.OrderedDict((rf, None) for rf in rfs)  # rf -> start time
+    def start_next():
+        rf = next(iter(unreported), None)
+        if rf is not None and unreported[rf] is None:
+            unreported[rf] = time.time()
+            write_status(project_dir, [rf], " STARTED", script_id)
+
+    def usage(start):
+        return dict(start=start, wall=time.time()-start, user=None, sys=None,\
+            maxrss_kb=None, output_bytes=None, batch=rfs[0])
+
+    # Follow the report file until the batch exits
+    start_next()
+    waiting = asyncio.ensure_future(wait_process(process))
+    offset, timed_out = 0, None
+    try:
+        while offset is not None:
+            done, _ = await asyncio.wait([waiting], timeout=1)
+            with open(report_path) as report:
+                report.seek(offset)
+                lines = report.readlines()
+            if lines and not lines[-1].endswith('\n'):
+                lines.pop()
+            offset = None if done else offset + sum(len(line) for line in lines)
+            for line in lines:
+                rf, rc = parse_report(line)
+                if rf is None or rf not in rfs:
+                    if line.strip():
+                        log.write(("\nIGNORED MALFORMED LINE OF THE BATCH REPORT: "\
+                            + line).encode())
+                    continue
+                if rf in unreported:
+                    start = unreported.pop(rf)
+                    if start is None:
+                        start = time.time()
+                        write_status(project_dir, [rf], " STARTED", script_id)
+                    finish_rf(project_dir, rf, script_id, rc, usage(start))
+                start_next()
+            current = next(iter(unreported), None)
+            if not done and current is not None and unreported[current] is not None and\
+                    time_left(unreported[current], timeout, deadline) == 0:
+                # the rf being run is out of time
+                if timed_out is None:
+                    timed_out = time.time()
+                    process.terminate()
+                elif time.time() > timed_out + KILL_GRACE:
+                    process.kill()
+        rc, _ = waiting.result()
+    finally:
+        del processes[rfs[0]]
+        terminate_group(process)
+        os.remove(report_path)
+        await output.wait_closed()
+        write_log(rf_paths[0], asheader("OUTPUT OF BATCH"))
         log.close()
-        status.close()
+
+    if unreported:
+        rf = next(iter(unreported))
+        start = unreported.pop(rf)
+        finish_rf(project_dir, rf, script_id, TIMED_OUT if timed_out is not None else\
+            rc or "0 WITHOUT REPORTING RF", usage(start))
+    for rf in unreported:
+        write_log(get_rf_path(project_dir,rf), "BATCH EXITED BEFORE RUNNING RF: REQUEUED",\
+            asheader("LOG FILE CLOSED "+get_timestamp()))
+    return list(unreported)
+
+def parse_report(line):
+    # the rf and exit code of a line "RF_PATH EXIT_CODE" of a batch report,
+    # or None and None if it is not one
+    try:
+        rf_path, rc = line.rsplit(None, 1)
+        return path.basename(path.normpath(rf_path)), int(rc)
+    except ValueError:
+        return None, None
+
+def batch_size(batch, batch_time, run_time, remaining, num_procs):
+    """
+    Number of rfs for the next batch: enough to last batch_time seconds at
+    the observed time per rf, at most batch, and small enough to spread the
+    remaining rfs over all processes.
+    """
+    size = batch if run_time is None else int(batch_time / max(run_time, 1e-3))
+    return max(1, min(size, batch, math.ceil(remaining / num_procs)))
+
+def restore_rf(project_dir, rf, script_id, cache):
+    """
+    Satisfy rf from cache instead of running it; returns whether it was
+    found in the cache.
+    """
+    key = cache.restore(rf)
+    if key is None:
+        return False
+    start_log(get_rf_path(project_dir,rf))
+    write_log(get_rf_path(project_dir,rf), "RESULTS RESTORED FROM CACHE ENTRY "+key)
+    write_status(project_dir, [rf], " STARTED", script_id)
+    finish_rf(project_dir, rf, script_id, 0)
+    return True
+
+def finish_rf(project_dir, rf, script_id, rc, usage=None, retry=False):
+    """
+    Mark rf FINISHED, FAILED, TIMEOUT (if rc is TIMED_OUT) or RETRYING (if
+    retry) after its run with exit code rc, and record its usage.
+    """
+    if usage is not None:
+        write_usage(project_dir, rf, dict(script_id=script_id, rc=rc, **usage))
+    lines = []
+    if rc == 0:
+        write_status(project_dir, [rf], "FINISHED", script_id)
+    elif rc == TIMED_OUT:
+        lines.append("SCRIPT TIMED OUT: TERMINATED")
+        write_status(project_dir, [rf], " TIMEOUT", script_id)
+    else:
+        lines.append("SCRIPT RETURNED WITH EXIT CODE "+str(rc))
+        write_status(project_dir, [rf], "RETRYING" if retry else "  FAILED", script_id)
+    write_log(get_rf_path(project_dir,rf), *lines, asheader("LOG FILE CLOSED "+get_timestamp()))
+
+async def start_worker(prog, project_dir, script_file, entry):
+    # the output of the worker is piped into the log of the rf it runs; output
+    # outside of runs goes to stderr, or to the log of the next run if not yet read
+    worker_path = path.join(path.dirname(path.abspath(__file__)), 'worker.py')
+    output = OutputPipe(forward_output)
+    try:
+        worker = await asyncio.create_subprocess_exec(prog, worker_path,\
+            path.join(project_dir, script_file), entry, stdin=subprocess.PIPE,\
+            stdout=subprocess.PIPE, stderr=output.write_fd, start_new_session=True)
+    finally:
+        output.detach()
+    worker.output = output
+    return worker
+
+async def stop_worker(worker):
+    if worker.returncode is None:
+        worker.stdin.close()
+        await worker.wait()
+    await worker.output.wait_closed()
+
+def time_left(start, timeout, deadline):
+    """
+    Seconds a run started at start may still take, given the timeout of runs
+    and the deadline of the sweep; None if neither is given.
+    """
+    ends = [end for end in (None if timeout is None else start + timeout, deadline)
+        if end is not None]
+    return max(0, min(ends) - time.time()) if ends else None
+
+async def wait_timeout(process, timeout=None):
+    """
+    Wait for process like wait_process, terminating it after timeout seconds
+    and killing it if it is still alive KILL_GRACE seconds later; returns its
+    exit code, resource usage and whether it timed out.
+    """
+    waiting = asyncio.ensure_future(wait_process(process))
+    done, _ = await asyncio.wait([waiting], timeout=timeout)
+    if done:
+        return waiting.result() + (False,)
+    process.terminate()
+    done, _ = await asyncio.wait([waiting], timeout=KILL_GRACE)
+    if not done:
+        process.kill()
+    return await waiting + (True,)
+
+async def wait_process(process):
+    """
+    Reap process without blocking the event loop and return its exit code
+    and resource usage.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        # a pidfd becomes readable once the child exits
+        fd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # no pidfds (macOS, old kernels, some seccomp profiles): a thread of
+        # its own blocks in wait4, as a shared pool of threads would hold
+        # finished runs back while its threads wait for longer ones
+        reaped = loop.create_future()
+        def reap():
+            try:
+                result = os.wait4(process.pid, 0)
+            except OSError as error:
+                settle = lambda: reaped.done() or reaped.set_exception(error)
+            else:
+                settle = lambda: reaped.done() or reaped.set_result(result)
+            try:
+                loop.call_soon_threadsafe(settle)
+            except RuntimeError:
+                pass    # the loop was closed meanwhile
+        threading.Thread(target=reap, daemon=True).start()
+        _, status, rusage = await reaped
+    else:
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+        _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status)\
+        else os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+def terminate_group(process, sig=signal.SIGTERM):
+    """
+    Send sig to the process group of process, which runs in a session of its
+    own, unless process was reaped.
+    """
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+def rusage_usage(rusage):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    maxrss_kb = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+    return dict(user=rusage.ru_utime, sys=rusage.ru_stime, maxrss_kb=maxrss_kb)
+
+def claim_rf(project_dir, rf, lease):
+    """
+    Atomically claim rf for this process by creating rfs/rf/.claim. A claim
+    which has not been renewed for lease seconds belongs to a dead sweep and
+    is taken over, under the lock rfs/rf/.claim.reclaim. Returns None if rf
+    is claimed by another sweep, and otherwise whether a claim was taken over.
+    """
+    claim_path = path.join(get_rf_path(project_dir,rf),'.claim')
+    if create_claim(claim_path):
+        return False
+    if not claim_expired(claim_path, lease):
+        return None
+
+    lock_path = claim_path + '.reclaim'
+    if not create_claim(lock_path):
+        if claim_expired(lock_path, lease):
+            # left behind by a sweep which died while reclaiming
+            release_rf(project_dir, rf, lock_path)
+        return None
+    try:
+        if not claim_expired(claim_path, lease):
+            return None
+        release_rf(project_dir, rf, claim_path)
+        return True if create_claim(claim_path) else None
+    finally:
+        release_rf(project_dir, rf, lock_path)
+
+def create_claim(claim_path):
+    try:
+        fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as file:
+        write(file, socket.gethostname() + " " + str(os.getpid()) + " " + get_timestamp())
+    return True
+
+def claim_expired(claim_path, lease):
+    try:
+        return os.stat(claim_path).st_mtime < time.time() - lease
+    except FileNotFoundError:
+        return True
+
+def renew_rf(project_dir, rf):
+    """
+    Renew the claim of rf by this process; returns False if it has none,
+    the claim having expired and been released or taken over.
+    """
+    claim_path = path.join(get_rf_path(project_dir,rf),'.claim')
+    try:
+        with open(claim_path) as file:
+            owner = file.read().split()[:2]
+        if owner != [socket.gethostname(), str(os.getpid())]:
+            return False
+        os.utime(claim_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def release_rf(project_dir, rf, claim_path=None):
+    try:
+        os.remove(claim_path or path.join(get_rf_path(project_dir,rf),'.claim'))
+    except FileNotFoundError:
+        pass
+
+def queue_claimed(project_dir, rf, script_id, reclaimed, rerun_failed, updates):
+    """
+    Mark a freshly claimed rf QUEUED if it still has to be run, and return
+    whether it does. The runs of dead sweeps whose claim was taken over are
+    killed (if QUEUED or RETRYING) or failed (if RUNNING or SPECULATIVE)
+    first. A FAILED or TIMEOUT rf is only rerun if its status is unchanged
+    since the start of this sweep.
+    """
+    status, lines = read_status(rf, project_dir, script_id)
+    if reclaimed and status in (Status.QUEUED, Status.RETRYING):
+        write_status(project_dir, [rf], "  KILLED", script_id)
+    elif reclaimed and status in (Status.RUNNING, Status.SPECULATIVE):
+        write_log(get_rf_path(project_dir,rf), "CLAIM EXPIRED: RUN ABANDONED BY ITS SWEEP")
+        write_status(project_dir, [rf], "  FAILED", script_id)
+    elif not (status is Status.NEW or (status in (Status.FAILED, Status.TIMEOUT)
+            and rerun_failed and lines == updates)):
+        return False
+    write_status(project_dir, [rf], "  QUEUED", script_id)
+    return True
+
+def raise_fd_limit():
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
@@ -1,33 +1,109 @@
 import os, os.path as path, shutil
 import numbers
-import numpy
 import hashlib, json
 import itertools
+import math
+import operator
+import socket
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-from .sweep_utils import get_timestamp
+from .sweep_utils import get_timestamp, index_rfs, Status, collect_rf_status
+from .sweep_utils import CONFIG_FILE, read_config, write_config, get_rf_path, list_rfs
+from .sweep_utils import RF_FILES, LOG_FILE, PACKS_DIR, read_packs, open_pack, index_packs
 
-def init_dir(project_dir):
+def init_dir(project_dir, fanout=None):
+    """
+    Make the folders of a project, and record the fanout of its rfs folder
+    (see sweep_utils.get_rf_path) if the project is new; the fanout of an
+    existing project is changed with migrate_rfs.
+    """
     dirs_to_make = [path.join(project_dir,dir) for dir in ['rfs','history','data']]
     [os.mkdir(dir) for dir in dirs_to_make if not path.exists(dir) ]
+    if not path.exists(path.join(project_dir,CONFIG_FILE)):
+        if fanout and os.listdir(path.join(project_dir,'rfs')):
+            raise ValueError("Project has rfs: change its fanout with `sweeps migrate`")
+        write_config(project_dir, dict(read_config(project_dir), fanout=fanout or 0))
+    elif fanout is not None and fanout != read_config(project_dir)['fanout']:
+        raise ValueError("Project has a fanout of " + str(read_config(project_dir)['fanout'])
+            + ": change it with `sweeps migrate`")
 
-def create_rfs(project_dir, sweep_file):
+def create_rfs(project_dir, sweep_file, shard=None, threads=16, batch_size=1000, fanout=None):
     """
+    Create the rfs of sweep_file which do not exist yet, or only shard
+    (i, n) of them (see read_sweep). The rfs are created in batches of
+    batch_size by up to threads threads, each rf in a hidden folder renamed
+    once complete, so an interrupted create is resumed by creating again.
+    A new project is laid out with the given fanout (see init_dir).
     """
     # make sure directory is initialized
-    init_dir(project_dir)
+    init_dir(project_dir, fanout)
 
     sweep_filepath = path.join(project_dir,sweep_file)
-    for rf, params in read_sweep(sweep_filepath):
-        # write indiviual params of given rf to a params.json
-        rf_path = path.join(project_dir,'rfs',rf)
-        if not path.exists(rf_path):
-            os.mkdir(rf_path)
-            with open(path.join(rf_path,'params.json'), 'w+') as file:
-                file.write(params)
-
-            # make status.txt and log.txt files
-            open(path.join(rf_path,'status.txt'),'w+').close()
-            open(path.join(rf_path,'log.txt'),'w+').close()
+    existing = set(list_rfs(project_dir)) | set(read_packs(project_dir))
+    total = count_sweep(sweep_filepath, shard)
+    done, start = 0, time.time()
+    parents = set()
+
+    claimed = threading.Lock()    # guards existing, as a sweep may repeat points
+
+    def create_batch(batch):
+        for rf, params in batch:
+            with claimed:
+                if rf in existing:
+                    continue
+                existing.add(rf)
+            rf_path = get_rf_path(project_dir,rf)
+            if path.exists(rf_path):
+                continue
+            # write indiviual params of given rf to a params.json
+            parent = path.dirname(rf_path)
+            if parent not in parents:
+                os.makedirs(parent, exist_ok=True)
+                parents.add(parent)
+            temp_path = path.join(parent,'.'+rf+'.tmp')
+            if path.exists(temp_path):
+                shutil.rmtree(temp_path)    # left by an interrupted create
+            try:
+                os.mkdir(temp_path)
+                with open(path.join(temp_path,'params.json'), 'w+') as file:
+                    file.write(params)
+
+                # make status.txt and log files
+                open(path.join(temp_path,'status.txt'),'w+').close()
+                open(path.join(temp_path,LOG_FILE),'w+').close()
+                os.rename(temp_path, rf_path)
+            except BaseException:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                raise
+        return [rf for rf, _ in batch]
+
+    def report(future):
+        nonlocal done
+        # existing rfs too, which an interrupted create may not have indexed
+        batch = future.result()
+        index_rfs(project_dir, batch)
+        done += len(batch)
+        print("\rCreated %d of %d rfs (%.0f/s)" % (done, total,\
+            done / max(time.time() - start, 1e-3)), end="", flush=True)
+
+    # keep a bounded number of batches in flight
+    with ThreadPoolExecutor(threads) as executor:
+        in_flight = []
+        points = read_sweep(sweep_filepath, shard)
+        while True:
+            batch = list(itertools.islice(points, batch_size))
+            if not batch:
+                break
+            in_flight.append(executor.submit(create_batch, batch))
+            if len(in_flight) >= 2 * threads:
+                report(in_flight.pop(0))
+        for future in in_flight:
+            report(future)
+    if total:
+        print()
 
     # copy sweeps file to a timestamped reference in history dir
     sweep = get_timestamp() + '.create.json'
@@ -39,10 +115,17 @@ def create_rfs(project_dir, sweep_file):
 def delete_rfs(project_dir, sweep_file):
     sweep_filepath = path.join(project_dir,sweep_file)
 
+    deleted_rfs = []
+    packed = read_packs(project_dir)
     for rf,_ in read_sweep(sweep_filepath): #TODO: Check equality of params.json?
-        rf_path = path.join(project_dir,'rfs',rf)
+        rf_path = get_rf_path(project_dir,rf)
         if path.exists(rf_path):
             shutil.rmtree(rf_path)
+            deleted_rfs.append(rf)
+        elif rf in packed:
+            deleted_rfs.append(rf)
+    delete_packed(project_dir, {rf: packed[rf] for rf in deleted_rfs if rf in packed})
+    index_rfs(project_dir, deleted_rfs, delete=True)
 
     sweep = get_timestamp() + '.delete.json'
     history_path = path.join(project_dir,'history')
@@ -50,37 +133,269 @@ def delete_rfs(project_dir, sweep_file):
         os.mkdir(history_path)
     shutil.copyfile(sweep_filepath, path.join(history_path,sweep))
 
-def read_sweep(sweep_file):
+def migrate_rfs(project_dir, fanout):
+    """
+    Move the rfs of project_dir to the layout with the given fanout (see
+    sweep_utils.get_rf_path). No sweep may run meanwhile; an interrupted
+    migration is completed by migrating again.
+    """
+    init_dir(project_dir)
+    rfs_path = path.join(project_dir,'rfs')
+
+    # find rfs at any depth, as a previous migration may have moved some
+    rf_paths, parents, folders = [], [rfs_path], []
+    while parents:
+        for entry in os.scandir(parents.pop()):
+            if entry.name[0] == '.' or not entry.is_dir():
+                continue
+            if len(entry.name) == 2:
+                parents.append(entry.path)
+                folders.append(entry.path)
+            else:
+                rf_paths.append(entry.path)
+
+    moved = 0
+    for rf_path in rf_paths:
+        target = get_rf_path(project_dir, path.basename(rf_path), fanout)
+        if rf_path != target:
+            os.makedirs(path.dirname(target), exist_ok=True)
+            os.rename(rf_path, target)
+            moved += 1
+    write_config(project_dir, dict(read_config(project_dir), fanout=fanout))
+
+    # remove folders of the previous layout
+    for folder in reversed(folders):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass    # still holds rfs
+    print("Moved " + str(moved) + " of " + str(len(rf_paths)) + " rfs to a fanout of "
+        + str(fanout))
+
+def pack_rfs(project_dir, sweep_file=None, pack_size=10000):
+    """
+    Move the finished rfs of project_dir, or only those of sweep_file, into
+    zip archives of up to pack_size rfs in project_dir/packs (see
+    sweep_utils). Results are stored uncompressed, so that they can be
+    memory-mapped, and the other files of the rfs compressed.
+    """
+    rfs = [rf for rf,_ in read_sweep(path.join(project_dir,sweep_file))]\
+        if sweep_file is not None else None
+    finished = collect_rf_status(project_dir, rfs=rfs)[Status.FINISHED]
+    rfs = sorted(rf for rf in finished if path.isdir(get_rf_path(project_dir,rf)))
+    packs_path = path.join(project_dir,PACKS_DIR)
+    os.makedirs(packs_path, exist_ok=True)
+
+    for start in range(0, len(rfs), pack_size):
+        chunk = rfs[start:start+pack_size]
+        pack = 'pack-' + get_timestamp() + '-' + str(os.getpid()) +\
+            '-%05d.zip' % (start // pack_size)
+        pack_path = path.join(packs_path,pack)
+        with zipfile.ZipFile(pack_path + '.tmp', 'w', allowZip64=True) as archive:
+            for rf in chunk:
+                rf_path = get_rf_path(project_dir,rf)
+                for root, dirs, files in os.walk(rf_path):
+                    dirs[:] = sorted(d for d in dirs if d[0] != '.')
+                    for name in sorted(files):
+                        if name[0] == '.':
+                            continue
+                        relative = path.relpath(path.join(root,name), rf_path)
+                        archive.write(path.join(root,name),\
+                            rf + '/' + relative.replace(os.sep, '/'),\
+                            zipfile.ZIP_DEFLATED if relative in RF_FILES and relative != LOG_FILE\
+                            else zipfile.ZIP_STORED)
+        with open(pack_path + '.tmp', 'rb') as file:
+            os.fsync(file.fileno())
+        os.rename(pack_path + '.tmp', pack_path)
+
+        # the folders are only removed once the archive is indexed
+        index_packs(project_dir, {rf: pack for rf in chunk})
+        for rf in chunk:
+            shutil.rmtree(get_rf_path(project_dir,rf))
+        print("Packed " + str(start + len(chunk)) + " of " + str(len(rfs)) + " rfs")
+
+def unpack_rfs(project_dir, rfs):
+    """
+    Move the packed rfs among rfs back into folders, e.g. to run them again.
+    """
+    packed = read_packs(project_dir)
+    packs = {}
+    for rf in rfs:
+        if rf in packed and not path.isdir(get_rf_path(project_dir,rf)):
+            packs.setdefault(packed[rf], set()).add(rf)
+
+    # distributed sweeps may unpack the same rfs at once: each unpacks into
+    # folders of its own, and the first to rename its folder wins
+    suffix = '.' + socket.gethostname() + '-' + str(os.getpid()) + '.tmp'
+    for pack, pack_rfs in packs.items():
+        archive = open_pack(project_dir, pack)
+        for name in archive.namelist():
+            rf, relative = name.split('/', 1)
+            if rf not in pack_rfs:
+                continue
+            target = path.join(path.dirname(get_rf_path(project_dir,rf)),'.'+rf+suffix,\
+                *relative.split('/'))
+            os.makedirs(path.dirname(target), exist_ok=True)
+            with archive.open(name) as infile, open(target, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile)
+        for rf in pack_rfs:
+            unpacked = path.join(path.dirname(get_rf_path(project_dir,rf)),'.'+rf+suffix)
+            try:
+                os.rename(unpacked, get_rf_path(project_dir,rf))
+            except OSError:
+                if not path.isdir(get_rf_path(project_dir,rf)):
+                    raise
+                shutil.rmtree(unpacked)
+    delete_packed(project_dir, {rf: pack for pack, pack_rfs in packs.items() for rf in pack_rfs})
+
+def delete_packed(project_dir, packed):
+    # record that the rfs of packed are no longer in their archives
+    if not packed:
+        return
+    with open(path.join(project_dir,PACKS_DIR,'deleted.txt'), 'a') as file:
+        for rf, pack in packed.items():
+            file.write(pack + ' ' + rf + '\n')
+    index_packs(project_dir, packed, delete=True)
+
+def read_options(sweep_file):
+    """
+    Return the options of a sweeps parameter file, i.e. the entries whose key
+    starts with an underscore, without the underscore: e.g. "_cost" gives
+    expressions for the cost of the runs (see sweep_stats.predict_usage).
+    """
+    with open(sweep_file) as file:
+        sweep = json.load(file)
+    return {key[1:]: item for key, item in sweep.items() if key.startswith('_')}
+
+def read_sweep(sweep_file, shard=None):
     """
     Given a sweeps parameter file sweep_file, returns a generator producing a
-    dictionary relating the rf to the splitted parameters.
+    dictionary relating the rf to the splitted parameters. Keys starting with
+    an underscore hold options (see read_options) rather than parameters.
+    If shard is a tuple (i, n), only every n-th rf starting from the i-th is
+    produced, so that n hosts can split the rfs between them.
+
+    Instead of the product of the values of its parameters, a sweep file
+    may list the parameters of each rf under "_points"; an adaptive sweep
+    (see sweep_adapt) produces the points of the rounds run so far.
+    """
+    points = read_points(sweep_file)
+    if points is not None:
+        if shard is not None:
+            points = itertools.islice(points, shard[0], None, shard[1])
+        for point in points:
+            params = json.dumps(point,indent=4,sort_keys=True)
+            yield (hashlib.md5(params.encode('utf-8')).hexdigest()[:16], params)
+        return
+
+    parameter_keys, parameter_values = read_values(sweep_file)
+
+    # serialize every value of each parameter once; the params of an rf are
+    # then joined from these as json.dumps(params,indent=4,sort_keys=True)
+    fragments = [['    ' + json.dumps(key) + ': ' +\
+        json.dumps(value,indent=4,sort_keys=True).replace('\n','\n    ')\
+        for value in values] for key, values in zip(parameter_keys, parameter_values)]
+    order = sorted(range(len(parameter_keys)), key=lambda index: parameter_keys[index])
+    sort = operator.itemgetter(*order) if len(order) > 1 else tuple
+
+    # make generator for rf : parameter
+    points = itertools.product(*fragments)
+    if shard is not None:
+        points = itertools.islice(points, shard[0], None, shard[1])
+    for values in points:
+        params = '{\n' + ',\n'.join(sort(values)) + '\n}' if values else '{}'
+        rf = hashlib.md5(params.encode('utf-8')).hexdigest()[:16]
+        yield (rf, params)
+
+def count_sweep(sweep_file, shard=None):
+    """
+    Return the number of rfs read_sweep produces for sweep_file and shard.
+    """
+    points = read_points(sweep_file)
+    total = len(points) if points is not None else\
+        math.prod(len(values) for values in read_values(sweep_file)[1])
+    if shard is not None:
+        total = len(range(shard[0], total, shard[1]))
+    return total
+
+def point_rf(point):
+    """
+    Return the rf of the parameters point, a dictionary.
+    """
+    params = json.dumps(point,indent=4,sort_keys=True)
+    return hashlib.md5(params.encode('utf-8')).hexdigest()[:16]
+
+def read_points(sweep_file):
+    """
+    Return the list of the parameters of each rf of a sweep file listing
+    them, or of an adaptive sweep, and None for other sweep files.
+    """
+    options = read_options(sweep_file)
+    if 'points' in options:
+        return options['points']
+    if 'adaptive' in options:
+        return [point for points in read_rounds(sweep_file) for point in points]
+    return None
+
+def rounds_path(sweep_file):
+    return path.splitext(sweep_file)[0] + '.rounds.json'
+
+def read_rounds(sweep_file):
+    """
+    Return the points of each round run of the adaptive sweep sweep_file.
+    """
+    try:
+        with open(rounds_path(sweep_file)) as file:
+            return json.load(file)['rounds']
+    except FileNotFoundError:
+        return []
+
+def read_axes(sweep_file):
+    """
+    Return the axes of the rfs of sweep_file in the order read_sweep produces
+    them, as a list of names and a list of values along each: the parameters
+    of a product of values, or the points of a sweep listing them.
+    """
+    points = read_points(sweep_file)
+    if points is not None:
+        return ['point'], [points]
+    return read_values(sweep_file)
+
+def read_values(sweep_file):
+    """
+    Return the parameters of sweep_file and the list of values of each.
     """
     with open(sweep_file) as file:
         sweep = json.load(file)
+    sweep = {key: item for key, item in sweep.items() if not key.startswith('_')}
+    parameter_keys = list(sweep.keys())
+    parameter_values = [read_parameter(key, item) for key, item in sweep.items()]
+    return parameter_keys, parameter_values
 
+def read_parameter(key, item):
+    """
+    Return the list of values of the parameter key, given its entry item in
+    a sweep file.
+    """
     # make handlers for given datatype
     dtype_handlers = dict()
     dtype_handlers['constant'] = lambda value : [value] if isinstance(value,numbers.Real)  \
                                                         else None
     dtype_handlers['manual'] = lambda value : value if isinstance(value,list) \
                                                     else None
-    dtype_handlers['linspace'] = lambda value : numpy.linspace(*value).tolist() \
+    dtype_handlers['linspace'] = lambda value : numpy_space('linspace', value) \
                                             if len(value) == 3 else None
-    dtype_handlers['logspace'] = lambda value : numpy.logspace(*value).tolist() \
+    dtype_handlers['logspace'] = lambda value : numpy_space('logspace', value) \
                                             if len(value) == 3 else None
     dtype_handlers['string'] = lambda value : [value]
     dtype_handlers['tuple'] = lambda value : [value] if isinstance(value,list) else None
 
-    parameter_keys = list(sweep.keys())
-    parameter_values = [dtype_handlers[item['sweep_type']](item['value'])  \
-                                for item in sweep.values()]
-    for index, value in enumerate(parameter_values):
-        if value is None:
-            raise ValueError("Value of parameter `" + str(parameter_keys[index]) + "` invalid")
+    values = dtype_handlers[item['sweep_type']](item['value'])
+    if values is None:
+        raise ValueError("Value of parameter `" + str(key) + "` invalid")
+    return values
 
-    # make generator for rf : parameter
-    for values in itertools.product(*parameter_values):
-        params = dict(zip(parameter_keys,values))
-        params = json.dumps(params,indent=4,sort_keys=True)
-        rf = hashlib.md5(params.encode('utf-8')).hexdigest()[:16]
-        yield (rf, params)
+def numpy_space(name, value):
+    # numpy is imported only for sweeps which need it, to keep startup fast
+    import numpy
+    return getattr(numpy, name)(*value).tolist()
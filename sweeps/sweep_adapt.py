@@ -0,0 +1,287 @@
+import os, os.path as path
+import itertools
+import json
+import math
+import numbers
+import random
+
+from .sweep_utils import Status, collect_rf_status, open_rf_file
+from .setup_sweep import create_rfs, read_options, read_parameter, rounds_path, point_rf
+from .run_sweep import run_sweep
+
+METHODS = ('refine', 'random', 'lhs', 'sobol', 'halving')
+
+def adapt_sweep(project_dir, prog, script_file, sweep_file, num_procs, rounds=None,
+        **run_options):
+    """
+    Run the adaptive sweep sweep_file in rounds: the rfs of each round are
+    chosen from the results of the previous ones as given by the _adaptive
+    option of the sweep file, written to the sweep file <name>.round<N>.json,
+    created with create_rfs and run with run_sweep (given run_options). The
+    method of the option is one of
+
+      refine   -- run the grid of the parameters, then repeatedly add the
+                  midpoints of the fraction (default 0.25) of the edges of
+                  the grid along which the objective changes most
+      random, lhs, sobol
+               -- sample budget points of the parameters uniformly, by Latin
+                  hypercube or by a scrambled Sobol sequence (needs scipy),
+                  split over rounds (default 1)
+      halving  -- run every configuration of the other parameters with
+                  min_resource of the parameter resource, then rerun the
+                  best 1/eta of them (default 3) by the objective with eta
+                  times more resource until max_resource
+
+    where parameters of sweep_type "range" or "logrange" with value [low,
+    high] are sampled from that interval, uniformly or log-uniformly. The
+    objective is a Python expression in result (the data file of an rf, or
+    the tuple of its data files, as collected by close in its results
+    column, i.e. without .npy results) and its parameters,
+    e.g. "result['loss']"; halving minimizes it unless goal is "max".
+
+    The points and objectives of the rounds are recorded in
+    <name>.rounds.json, from which read_sweep produces the rfs of all rounds
+    (e.g. for close) and from which the sweep is resumed when run again.
+    rounds overrides the number of rounds of the option.
+    """
+    sweep_filepath = path.join(project_dir, sweep_file)
+    with open(sweep_filepath) as file:
+        sweep = json.load(file)
+    adaptive = read_options(sweep_filepath).get('adaptive')
+    if adaptive is None or adaptive.get('method') not in METHODS:
+        raise ValueError("Sweep file needs an _adaptive option with a method among "
+            + ", ".join(METHODS))
+    method = adaptive['method']
+    parameters = {key: item for key, item in sweep.items() if not key.startswith('_')}
+    total = rounds or adaptive.get('rounds') or (1 if method in ('random', 'lhs', 'sobol')\
+        else halving_rounds(adaptive) if method == 'halving' else 3)
+
+    record = {'method': method, 'rounds': [], 'values': {}}
+    if path.exists(rounds_path(sweep_filepath)):
+        with open(rounds_path(sweep_filepath)) as file:
+            record = json.load(file)
+    name = path.splitext(sweep_file)[0]
+
+    # rerun the latest round, which may have been interrupted, then go on
+    for number in range(max(0, len(record['rounds']) - 1), total):
+        if number == len(record['rounds']):
+            points = propose(method, adaptive, parameters, number, total, record)
+            if not points:
+                print("Adaptive sweep converged after " + str(number) + " rounds.")
+                break
+            record['rounds'].append(points)
+            write_record(sweep_filepath, record)
+        print("ROUND " + str(number) + ": " + str(len(record['rounds'][number])) + " rfs")
+
+        round_file = name + '.round' + str(number) + '.json'
+        with open(path.join(project_dir, round_file), 'w') as file:
+            json.dump({'_points': record['rounds'][number], '_round': number}, file, indent=4)
+        create_rfs(project_dir, round_file)
+        run_sweep(project_dir, prog, script_file, num_procs, round_file, **run_options)
+        if path.exists(path.join(project_dir, round_file)):
+            os.remove(path.join(project_dir, round_file))   # kept in history
+
+        rfs = [point_rf(point) for point in record['rounds'][number]]
+        record['values'].update(evaluate(project_dir, script_file,\
+            [rf for rf in rfs if record['values'].get(rf) is None],\
+            adaptive.get('objective', 'result'), num_procs))
+        write_record(sweep_filepath, record)
+
+def write_record(sweep_filepath, record):
+    with open(rounds_path(sweep_filepath) + '.tmp', 'w') as file:
+        json.dump(record, file)
+    os.replace(rounds_path(sweep_filepath) + '.tmp', rounds_path(sweep_filepath))
+
+def evaluate(project_dir, script_file, rfs, objective, workers=None):
+    """
+    Return a dictionary relating each finished rf in rfs to the value of the
+    objective on its results, or None if it cannot be evaluated.
+    """
+    from .close_sweep import load_results
+
+    finished = collect_rf_status(project_dir, rfs=rfs, script=script_file)[Status.FINISHED]
+    values = {}
+    for rf, data in load_results(project_dir, sorted(finished), workers, arrays=False):
+        with open_rf_file(project_dir, rf, 'params.json', 'r') as param_file:
+            params = json.load(param_file)
+        variables = dict(vars(math))
+        variables.update(params)
+        variables.update(result=None if not data else data[0] if len(data) == 1 else data,\
+            params=params)
+        try:
+            value = eval(objective, {'__builtins__': {}}, variables)
+            values[rf] = None if value is None else float(value)
+        except Exception as error:
+            print("Warning: objective of rf " + rf + " not evaluated: " + repr(error))
+            values[rf] = None
+    return values
+
+def propose(method, adaptive, parameters, number, total, record):
+    """
+    Return the points of round number of an adaptive sweep, given the points
+    and objectives of the previous rounds in record.
+    """
+    if method == 'refine':
+        return propose_refine(adaptive, parameters, number, record)
+    if method == 'halving':
+        return propose_halving(adaptive, parameters, number, record)
+    points = sample_unique(method, parameters, adaptive.get('budget', 100),\
+        adaptive.get('seed', 0))
+    done = {point_rf(point) for points in record['rounds'] for point in points}
+    return [point for point in points[len(points) * number // total :
+        len(points) * (number + 1) // total] if point_rf(point) not in done]
+
+def read_space(parameters):
+    """
+    Return the parameters of a sweep which take a single value, as a
+    dictionary, and the others as a list of (key, to_value), where to_value
+    maps [0, 1) onto the values of the parameter.
+    """
+    fixed, varying = {}, []
+    for key, item in parameters.items():
+        if item['sweep_type'] in ('range', 'logrange'):
+            low, high = item['value']
+            if item['sweep_type'] == 'range':
+                varying.append((key, lambda u, low=low, high=high: low + u * (high - low)))
+            else:
+                varying.append((key, lambda u, low=low, high=high: low * (high / low)**u))
+            continue
+        values = read_parameter(key, item)
+        if len(values) == 1:
+            fixed[key] = values[0]
+        else:
+            varying.append((key, lambda u, values=values:\
+                values[min(int(u * len(values)), len(values) - 1)]))
+    return fixed, varying
+
+def sample(method, parameters, budget, seed=0):
+    """
+    Return budget points of parameters sampled uniformly ('random'), by
+    Latin hypercube ('lhs') or by a scrambled Sobol sequence ('sobol').
+    """
+    fixed, varying = read_space(parameters)
+    dimensions = len(varying)
+    rng = random.Random(seed)
+    if method == 'random' or not dimensions:
+        design = [[rng.random() for _ in range(dimensions)] for _ in range(budget)]
+    elif method == 'lhs':
+        # one sample in each of budget strata along every dimension
+        columns = []
+        for _ in range(dimensions):
+            strata = list(range(budget))
+            rng.shuffle(strata)
+            columns.append([(stratum + rng.random()) / budget for stratum in strata])
+        design = [list(row) for row in zip(*columns)]
+    else:
+        from scipy.stats import qmc    # scipy needs to be installed for sobol
+        design = qmc.Sobol(dimensions, scramble=True, seed=seed).random(budget).tolist()
+    return [dict(fixed, **{key: to_value(u) for (key, to_value), u in zip(varying, row)})
+        for row in design]
+
+def sample_unique(method, parameters, budget, seed=0):
+    """
+    Return up to budget distinct points of parameters sampled by method (see
+    sample), as parameters with lists of values may give a point more than
+    once: more points are drawn until budget are distinct, or all of a
+    space of lists are.
+    """
+    size = 1
+    for key, item in parameters.items():
+        size *= math.inf if item['sweep_type'] in ('range', 'logrange')\
+            else len(read_parameter(key, item))
+    budget = min(budget, size)
+    draws = budget
+    while True:
+        points = {}
+        for point in sample(method, parameters, draws, seed):
+            points.setdefault(point_rf(point), point)
+        if len(points) >= budget or draws >= 100 * budget:
+            return list(points.values())[:budget]
+        draws *= 2
+
+def propose_refine(adaptive, parameters, number, record):
+    grid = {}
+    for key, item in parameters.items():
+        if item['sweep_type'] in ('range', 'logrange'):
+            raise ValueError("Parameter `" + key + "` of a refined sweep needs a list of values")
+        grid[key] = read_parameter(key, item)
+    if number == 0:
+        return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+    points = [point for points in record['rounds'] for point in points]
+    seen = {json.dumps(point, sort_keys=True) for point in points}
+    known = [(point, record['values'].get(point_rf(point))) for point in points]
+    known = [(point, value) for point, value in known
+        if value is not None and math.isfinite(value)]
+
+    # edges between neighbouring points along each axis of the grid
+    edges = []
+    for key in (key for key, values in grid.items() if len(values) > 1):
+        lines = {}
+        for point, value in known:
+            others = json.dumps({k: v for k, v in point.items() if k != key}, sort_keys=True)
+            lines.setdefault(others, []).append((point, value))
+        for line in lines.values():
+            line.sort(key=lambda item: item[0][key])
+            for (p, a), (q, b) in zip(line, line[1:]):
+                edges.append((abs(b - a), key, p, q))
+
+    # only edges with a value between their ends, which integer or
+    # categorical axes may not have, and not run yet can be split
+    splits = []
+    for change, key, p, q in edges:
+        value = midpoint(p[key], q[key], parameters[key]['sweep_type'] == 'logspace')
+        point = dict(p, **{key: value})
+        if value is not None and json.dumps(point, sort_keys=True) not in seen:
+            splits.append((change, point))
+    splits.sort(key=lambda split: -split[0])
+
+    new_points = []
+    count = math.ceil(adaptive.get('fraction', 0.25) * len(splits))
+    for change, point in splits[:count]:
+        if change <= adaptive.get('threshold', 0):
+            break
+        if json.dumps(point, sort_keys=True) not in seen:
+            seen.add(json.dumps(point, sort_keys=True))
+            new_points.append(point)
+    return new_points
+
+def midpoint(a, b, log=False):
+    # None if there is no value between a and b
+    if not all(isinstance(x, numbers.Real) and not isinstance(x, bool) for x in (a, b)):
+        return None
+    if isinstance(a, int) and isinstance(b, int):
+        middle = (a + b) // 2
+        return None if middle in (a, b) else middle
+    if log and a > 0 and b > 0:
+        return math.sqrt(a * b)
+    return (a + b) / 2
+
+def halving_rounds(adaptive):
+    return int(math.log(adaptive['max_resource'] / adaptive['min_resource'],\
+        adaptive.get('eta', 3)) + 1e-9) + 1
+
+def propose_halving(adaptive, parameters, number, record):
+    resource, eta = adaptive['resource'], adaptive.get('eta', 3)
+    low, high = adaptive['min_resource'], adaptive['max_resource']
+    if number > 0 and min(low * eta**(number - 1), high) >= high:
+        return []
+    amount = min(low * eta**number, high)
+    if number == 0:
+        parameters = {key: item for key, item in parameters.items() if key != resource}
+        if any(item['sweep_type'] in ('range', 'logrange') for item in parameters.values()):
+            configs = sample_unique('random', parameters, adaptive.get('budget', 27),\
+                adaptive.get('seed', 0))
+        else:
+            grid = {key: read_parameter(key, item) for key, item in parameters.items()}
+            configs = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+        return [dict(config, **{resource: amount}) for config in configs]
+
+    # the best 1/eta of the configurations of the previous round go on
+    previous = record['rounds'][number - 1]
+    scored = [(record['values'].get(point_rf(point)), point) for point in previous]
+    scored = [(value, point) for value, point in scored
+        if value is not None and math.isfinite(value)]
+    scored.sort(key=lambda item: item[0], reverse=adaptive.get('goal', 'min') == 'max')
+    return [dict(point, **{resource: amount})
+        for _, point in scored[:max(1, len(previous) // eta)]]
@@ -0,0 +1,178 @@
+import os, os.path as path, shutil
+import ast
+import hashlib
+import json
+
+from .sweep_utils import RF_FILES, get_rf_path
+
+CACHE_DIR = 'cache'
+
+def hash_source(filepath):
+    """
+    Hash the contents of filepath; for Python sources, hash their syntax tree
+    instead, so that comments and formatting do not change the hash.
+    """
+    with open(filepath, 'rb') as file:
+        contents = file.read()
+    if filepath.endswith('.py'):
+        try:
+            contents = ast.dump(ast.parse(contents)).encode('utf-8')
+        except (SyntaxError, ValueError):
+            pass
+    return hashlib.md5(contents).hexdigest()
+
+def hash_path(filepath):
+    # files directly, directories by the hashes of their files
+    if not path.isdir(filepath):
+        return hash_source(filepath)
+    hashes = []
+    for root, dirs, files in os.walk(filepath):
+        dirs.sort()
+        for name in sorted(files):
+            hashes.append(path.relpath(path.join(root, name), filepath) + ' ' +\
+                hash_source(path.join(root, name)))
+    return hashlib.md5('\n'.join(hashes).encode('utf-8')).hexdigest()
+
+def result_files(rf_path):
+    """
+    Return the paths relative to rf_path of the results in it, i.e. all files
+    but the bookkeeping files of sweeps and hidden files.
+    """
+    results = []
+    for root, dirs, files in os.walk(rf_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            relative = path.relpath(path.join(root, name), rf_path)
+            if name.startswith('.') or relative in RF_FILES:
+                continue
+            results.append(relative)
+    return sorted(results)
+
+def link_or_copy(source, destination):
+    os.makedirs(path.dirname(destination), exist_ok=True)
+    if path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def detach_rf(rf_path):
+    """
+    Replace the results in rf_path which are hard links, e.g. into the cache,
+    by copies, so that a script run in rf_path cannot overwrite a cached
+    result in place.
+    """
+    for relative in result_files(rf_path):
+        filepath = path.join(rf_path, relative)
+        if os.stat(filepath).st_nlink > 1:
+            shutil.copy2(filepath, filepath + '.detach')
+            os.replace(filepath + '.detach', filepath)
+
+class ResultCache:
+    """
+    Cache of the results of runs in the cache folder of a project, keyed by
+    the parameters of an rf, the program and script run and the files the
+    script depends on. Entries are evicted least recently used first once
+    the cache holds more than max_size MB.
+    """
+    def __init__(self, project_dir, prog, script_file, depends=(), max_size=10240):
+        self.project_dir = project_dir
+        self.cache_path = path.join(project_dir, CACHE_DIR)
+        self.max_size = max_size * 2**20
+        self.hits, self.misses = 0, 0
+        os.makedirs(self.cache_path, exist_ok=True)
+
+        hashes = [prog, hash_source(path.join(project_dir, script_file))]
+        for dependency in sorted(depends):
+            hashes.append(dependency + ' ' + hash_path(path.join(project_dir, dependency)))
+        self.script_hash = hashlib.md5('\n'.join(hashes).encode('utf-8')).hexdigest()
+        self.size = sum(entry_size(self.entry_path(key)) for key in self.entries())
+
+    def entries(self):
+        return [key for key in os.listdir(self.cache_path) if '.' not in key]
+
+    def entry_path(self, key):
+        return path.join(self.cache_path, key)
+
+    def key(self, rf):
+        with open(path.join(get_rf_path(self.project_dir,rf),'params.json')) as param_file:
+            params = json.dumps(json.load(param_file), sort_keys=True)
+        return hashlib.md5((params + '\n' + self.script_hash).encode('utf-8')).hexdigest()
+
+    def restore(self, rf):
+        """
+        Link the cached results for rf into its folder; returns the key of
+        the entry, or None if rf is not in the cache.
+        """
+        key = self.key(rf)
+        entry_path = self.entry_path(key)
+        try:
+            if not path.isdir(entry_path):
+                raise FileNotFoundError(entry_path)
+            for relative in result_files(entry_path):
+                link_or_copy(path.join(entry_path, relative),\
+                    path.join(get_rf_path(self.project_dir, rf), relative))
+            os.utime(entry_path)
+        except FileNotFoundError:
+            # not cached, or evicted meanwhile
+            self.misses += 1
+            return None
+        self.hits += 1
+        return key
+
+    def store(self, rf):
+        """
+        Add the results of the finished rf to the cache and evict entries if
+        the cache is full.
+        """
+        key = self.key(rf)
+        entry_path = self.entry_path(key)
+        if path.exists(entry_path):
+            os.utime(entry_path)
+            return
+        # build the entry aside, so that concurrent sweeps never see it partially
+        rf_path = get_rf_path(self.project_dir, rf)
+        temp_path = entry_path + '.' + str(os.getpid())
+        for relative in result_files(rf_path):
+            link_or_copy(path.join(rf_path, relative), path.join(temp_path, relative))
+        os.makedirs(temp_path, exist_ok=True)
+        try:
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # stored by another sweep meanwhile
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        self.size += entry_size(entry_path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for key in self.entries():
+            try:
+                entries.append((os.stat(self.entry_path(key)).st_mtime, key))
+            except FileNotFoundError:
+                pass
+        self.size = sum(entry_size(self.entry_path(key)) for _, key in entries)
+        for _, key in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            self.size -= entry_size(self.entry_path(key))
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        return "Cache: %d hits, %d misses (%.1f%% hit rate), %.1fMB cached" %\
+            (self.hits, self.misses, rate, self.size / 2**20)
+
+def entry_size(entry_path):
+    size = 0
+    for root, _, files in os.walk(entry_path):
+        for name in files:
+            try:
+                size += os.lstat(path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
@@ -0,0 +1,201 @@
+import os.path as path
+import collections
+import functools
+import json
+import pickle
+import warnings
+
+from .sweep_utils import get_rf_path, open_rf_file
+
+ENTRY_POINT_GROUP = 'sweeps.loaders'
+
+Loader = collections.namedtuple('Loader', ('load', 'lazy'))
+
+LOADERS = {}
+
+def register_loader(suffix, load=None, lazy=False):
+    """
+    Register load as the loader of result files ending in suffix, replacing
+    any loader registered before for it. load(file, lazy) is given the path
+    of the file, or a binary file object for files of packed rfs, and returns
+    its contents. If lazy, the loader can return a lazy or memory-mapped
+    handle (e.g. an open h5py.File) when called with lazy=True; the caller
+    then owns the handle. May be used as a decorator:
+
+        @register_loader('.zarr', lazy=True)
+        def load_zarr(file, lazy=False):
+            ...
+
+    Packages can also register loaders for the entry point group
+    sweeps.loaders, named by suffix, e.g. in setup.py:
+
+        entry_points={'sweeps.loaders': ['.arrow = mypackage:load_arrow']}
+
+    where a lazy attribute of the loader marks it as lazy. Loaders
+    registered at runtime are passed on to the processes which close
+    decodes in, so they need to be defined at the top level of a module.
+    """
+    if load is None:
+        return functools.partial(register_loader, suffix, lazy=lazy)
+    LOADERS[suffix] = Loader(load, lazy)
+    return load
+
+def shared_loaders():
+    """
+    Return the registered loaders which can be passed to other processes,
+    warning about the others: pools of processes started by spawn or
+    forkserver (the default on macOS) do not inherit loaders registered at
+    runtime, and install these with install_loaders instead.
+    """
+    loaders = {}
+    for suffix, loader in LOADERS.items():
+        try:
+            pickle.dumps(loader)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            warnings.warn("Loader of " + suffix + " files cannot be passed to other processes:"
+                " define it at the top level of a module")
+            continue
+        loaders[suffix] = loader
+    return loaders
+
+def install_loaders(loaders):
+    # initializer of the processes of pools (see shared_loaders)
+    LOADERS.update(loaders)
+
+@functools.lru_cache(maxsize=None)
+def load_entry_points():
+    import importlib.metadata
+    entry_points = importlib.metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        entry_points = entry_points.get(ENTRY_POINT_GROUP, ())   # before Python 3.10
+    for entry_point in entry_points:
+        if entry_point.name not in LOADERS:
+            load = entry_point.load()
+            register_loader(entry_point.name, load, getattr(load, 'lazy', False))
+
+def find_loader(filename):
+    """
+    Return the loader registered for the longest suffix of filename, or None
+    if filename is not a result file.
+    """
+    load_entry_points()
+    suffixes = [suffix for suffix in LOADERS if filename.endswith(suffix)]
+    return LOADERS[max(suffixes, key=len)] if suffixes else None
+
+@register_loader('.hdf5', lazy=True)
+def load_hdf5(file, lazy=False):
+    # the open file if lazy, otherwise its contents as nested dictionaries
+    import h5py
+    handle = h5py.File(file, 'r')
+    if lazy:
+        return handle
+    with handle:
+        return read_hdf5_group(handle)
+
+def read_hdf5_group(group):
+    import h5py
+    return {key: read_hdf5_group(item) if isinstance(item, h5py.Group) else item[()]
+        for key, item in group.items()}
+
+@register_loader('.jld', lazy=True)
+@register_loader('.jld2', lazy=True)
+def load_jld(file, lazy=False):
+    # Julia JLD or JLD2 file, which uses HDF5 encoding; a single matrix is
+    # returned as an array, transposed as Julia stores data in column major
+    # order, as opposed to row major used by numpy
+    import h5py
+    import numpy as np
+    handle = h5py.File(file, 'r')
+    keys = list(handle.keys())
+    if len(keys) != 1 or isinstance(handle[keys[0]], h5py.Group):
+        if lazy:
+            return handle
+        with handle:
+            return read_hdf5_group(handle)
+    with handle:
+        return np.transpose(np.array(handle.get(keys[0])))
+
+@register_loader('.mat')
+def load_mat(file, lazy=False):
+    import scipy.io
+    return scipy.io.loadmat(file)
+
+@register_loader('.json')
+def load_json(file, lazy=False):
+    if isinstance(file, str):
+        with open(file, 'rb') as data_file:
+            return json.load(data_file)
+    return json.load(file)
+
+@register_loader('.bson')
+def load_bson(file, lazy=False):
+    import bson     # bson needs to be installed: pip install bson
+    if isinstance(file, str):
+        with open(file, 'rb') as bson_file:
+            return bson.loads(bson_file.read())
+    return bson.loads(file.read())
+
+@register_loader('.npz', lazy=True)
+def load_npz(file, lazy=False):
+    # the NpzFile, decoding arrays on access, if lazy
+    import numpy as np
+    npz = np.load(file)
+    if lazy:
+        return npz
+    with npz:
+        return dict(npz)
+
+@register_loader('.pklz')
+def load_pklz(file, lazy=False):
+    import gzip
+    with gzip.open(file) as pickle_file:
+        return pickle.load(pickle_file)
+
+@register_loader('.pkl')
+def load_pkl(file, lazy=False):
+    import pandas as pd
+    return pd.read_pickle(file)
+
+@register_loader('.npy', lazy=True)
+def load_npy(file, lazy=False):
+    # memory-mapped if lazy, zero-copy from the archive for packed rfs
+    import numpy as np
+    if not lazy:
+        return np.load(file)
+    if isinstance(file, str):
+        return np.load(file, mmap_mode='r')
+    shape, fortran_order, dtype = read_array_header(file)
+    order = 'F' if fortran_order else 'C'
+    if not hasattr(file, 'getbuffer'):     # compressed in its archive
+        return np.frombuffer(file.read(), dtype).reshape(shape, order=order)
+    count = int(np.prod(shape))
+    return np.frombuffer(file.getbuffer(), dtype, count=count, offset=file.tell())\
+        .reshape(shape, order=order)
+
+def read_array_header(file):
+    # shape, order and dtype of an .npy file, leaving file at its data
+    import numpy as np
+    version = np.lib.format.read_magic(file)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(file)
+    return np.lib.format.read_array_header_2_0(file)
+
+def load_file(project_dir, rf, filename, lazy=False):
+    """
+    Return the contents of the result file filename of rf decoded by its
+    loader, or a lazy handle if lazy and the loader supports it.
+    """
+    loader = find_loader(filename)
+    if loader is None:
+        raise ValueError("No loader registered for " + filename)
+    lazy = lazy and loader.lazy
+    rf_path = get_rf_path(project_dir, rf)
+    if path.isdir(rf_path):
+        return loader.load(path.join(rf_path, filename), lazy)
+    # files of packed rfs are read from their archive
+    if lazy:
+        return loader.load(open_rf_file(project_dir, rf, filename), lazy)
+    with open_rf_file(project_dir, rf, filename) as file:
+        return loader.load(file, lazy)
@@ -0,0 +1,237 @@
+import os, os.path as path
+import asyncio
+import collections
+import gzip
+import shutil
+import sys
+import time
+import zlib
+
+from .sweep_utils import LOG_FILE, LOG_INDEX, asheader, write, get_timestamp, get_rf_path
+from .sweep_utils import open_rf_file
+
+# ---------------------------------------------------------------------------
+# Logs: the log.gz of an rf is a concatenation of gzip members, which gzip
+# and zcat read as one stream, so that logs are appended to, and merged by
+# close, by copying compressed bytes. The output of a run is compressed into
+# a hidden file of the rf as it arrives, where it can be followed with zcat,
+# and appended to the log as one member when the run ends. log.idx records
+# the offset in the log at which each attempt to run the rf starts.
+OUTPUT_FILE = '.output.gz'
+LOG_LIMIT = 10 * 2**20  # bytes of output kept per run by default
+FLUSH_INTERVAL = 1      # seconds between flushes of the output of a run
+OUTPUT_GRACE = 1        # seconds to wait for output after a run exits
+
+def append_log(rf_path, data):
+    with open(path.join(rf_path, LOG_FILE), 'ab') as log:
+        log.write(gzip.compress(data, mtime=0))
+
+def write_log(rf_path, *lines):
+    """
+    Append lines to the log of the rf at rf_path, as a gzip member.
+    """
+    append_log(rf_path, ''.join(line + '\n' for line in lines).encode())
+
+def read_output(rf_path):
+    # the output of the current run so far, up to its last flush
+    try:
+        with open(path.join(rf_path, OUTPUT_FILE), 'rb') as output:
+            return zlib.decompressobj(31).decompress(output.read())
+    except FileNotFoundError:
+        return b''
+
+def recover_output(rf_path):
+    # output of a run whose sweep was killed before appending it to the log
+    output_path = path.join(rf_path, OUTPUT_FILE)
+    if path.exists(output_path):
+        append_log(rf_path, read_output(rf_path)\
+            + "\nOUTPUT OF AN INTERRUPTED RUN RECOVERED\n".encode())
+        os.remove(output_path)
+
+def start_log(rf_path):
+    """
+    Start an attempt in the log of the rf at rf_path, recording its offset in
+    the index of the log. The output of a previous attempt whose sweep was
+    killed is recovered first.
+    """
+    recover_output(rf_path)
+    log_path = path.join(rf_path, LOG_FILE)
+    offset = path.getsize(log_path) if path.exists(log_path) else 0
+    with open(path.join(rf_path, LOG_INDEX), 'a') as index:
+        write(index, str(offset) + " " + get_timestamp())
+    write_log(rf_path, asheader("LOG FILE OPENED " + get_timestamp()))
+
+class LogWriter:
+    """
+    Compress the output of a run of the rf at rf_path as it is written, and
+    append it to the log of the rf when closed. If the output exceeds limit
+    bytes (unless limit is 0), only its first and last limit/2 bytes are
+    kept, with the number of bytes dropped in between.
+    """
+    def __init__(self, rf_path, limit=LOG_LIMIT):
+        self.rf_path = rf_path
+        self.output_path = path.join(rf_path, OUTPUT_FILE)
+        self.head = limit - limit // 2 if limit else None
+        self.tail_limit = limit // 2
+        self.tail, self.tail_size = collections.deque(), 0
+        self.size = 0
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)   # a gzip member
+        self.flushed = time.time()
+        open(self.output_path, 'wb').close()
+
+    def write(self, data):
+        kept = len(data) if self.head is None else max(0, min(len(data), self.head - self.size))
+        self.size += len(data)
+        self.append(self.compressor.compress(data[:kept]))
+        if kept < len(data):
+            # the tail holds at most one chunk more than tail_limit bytes
+            self.tail.append(data[kept:])
+            self.tail_size += len(data) - kept
+            while self.tail and self.tail_size - len(self.tail[0]) >= self.tail_limit:
+                self.tail_size -= len(self.tail.popleft())
+        if time.time() > self.flushed + FLUSH_INTERVAL:
+            self.append(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.flushed = time.time()
+
+    def append(self, data):
+        # the file is only held open while writing, as runs may be many
+        if data:
+            with open(self.output_path, 'ab') as output:
+                output.write(data)
+
+    def close(self):
+        """
+        Append the output to the log of the rf; returns the number of bytes
+        of output and of those dropped.
+        """
+        tail = b''.join(self.tail)
+        tail = tail[max(0, len(tail) - self.tail_limit):]
+        dropped = self.size - (self.size if self.head is None else min(self.size, self.head))\
+            - len(tail)
+        if dropped:
+            self.append(self.compressor.compress(\
+                ("\n[... " + str(dropped) + " BYTES OF OUTPUT DROPPED ...]\n").encode()))
+        self.append(self.compressor.compress(tail) + self.compressor.flush())
+        with open(self.output_path, 'rb') as output,\
+                open(path.join(self.rf_path, LOG_FILE), 'ab') as log:
+            shutil.copyfileobj(output, log)
+        os.remove(self.output_path)
+        return self.size, dropped
+
+class OutputPipe:
+    """
+    A pipe for the output of child processes, passed to sink as it arrives
+    on the running event loop. The write end, write_fd, is given to the child
+    and closed with detach once it is spawned.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.loop = asyncio.get_running_loop()
+        self.closed = self.loop.create_future()
+        self.loop.add_reader(self.read_fd, self.read)
+
+    def detach(self):
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            self.write_fd = None
+
+    def read(self, drain=False):
+        # one read per call, so that a chatty child cannot stall the loop,
+        # unless drain, which reads all output written so far
+        while not self.closed.done():
+            try:
+                data = os.read(self.read_fd, 65536)
+            except BlockingIOError:
+                return
+            if not data:
+                self.close()
+                return
+            self.sink(data)
+            if not drain:
+                return
+
+    def close(self):
+        if not self.closed.done():
+            self.loop.remove_reader(self.read_fd)
+            os.close(self.read_fd)
+            self.closed.set_result(None)
+
+    async def wait_closed(self, timeout=OUTPUT_GRACE):
+        """
+        Wait for the end of the output, for at most timeout seconds after
+        which the output left to children of the child is dropped.
+        """
+        self.detach()
+        await asyncio.wait([self.closed], timeout=timeout)
+        self.read(drain=True)
+        self.close()
+
+def forward_output(data):
+    # output produced outside of runs, e.g. by warm workers importing a script
+    sys.stderr.buffer.write(data)
+    sys.stderr.flush()
+
+def read_log_index(project_dir, rf):
+    try:
+        with open_rf_file(project_dir, rf, LOG_INDEX, 'r') as index:
+            return [int(line.split()[0]) for line in index if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def read_log(project_dir, rf, attempt=None):
+    """
+    Return the log of rf, or only that of its attempt-th run (from 0, or
+    from the last if negative), decompressed, with the output so far of the
+    run going on, if any. The log.txt of rfs run before logs were compressed
+    comes first.
+    """
+    try:
+        with open_rf_file(project_dir, rf, 'log.txt') as log:
+            text = log.read()
+    except FileNotFoundError:
+        text = b''
+    try:
+        with open_rf_file(project_dir, rf, LOG_FILE) as log:
+            data = log.read()
+    except FileNotFoundError:
+        data = b''
+    output = read_output(get_rf_path(project_dir, rf))
+    if attempt is None:
+        return text + gzip.decompress(data) + output
+    offsets = read_log_index(project_dir, rf)
+    attempts = list(zip(offsets, offsets[1:] + [len(data)]))
+    if not -len(attempts) <= attempt < len(attempts):
+        raise ValueError("No attempt " + str(attempt) + " of rf " + rf + ", which has "
+            + str(len(attempts)) + " attempts")
+    start, end = attempts[attempt]
+    return gzip.decompress(data[start:end]) + (output if end == len(data) else b'')
+
+def copy_log(project_dir, rf, merged, offset=0, text_offset=0):
+    """
+    Append the log of rf from offset on to the compressed log merged, an open
+    file, without decompressing it; the log.txt of rfs run before logs were
+    compressed is compressed from text_offset on. Returns the new offsets.
+    """
+    try:
+        with open_rf_file(project_dir, rf, 'log.txt') as log:
+            log.seek(text_offset)
+            chunks = iter(lambda: log.read(2**20), b'')
+            for chunk in chunks:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                merged.write(compressor.compress(chunk))
+                for chunk in chunks:
+                    merged.write(compressor.compress(chunk))
+                merged.write(compressor.flush())
+            text_offset = log.tell()
+    except FileNotFoundError:
+        pass
+    try:
+        with open_rf_file(project_dir, rf, LOG_FILE) as log:
+            log.seek(offset)
+            shutil.copyfileobj(log, merged)
+            offset = log.tell()
+    except FileNotFoundError:
+        pass
+    return offset, text_offset
@@ -0,0 +1,189 @@
+import os
+import json
+import math
+import random
+import statistics
+
+from .sweep_utils import Status, collect_rf_status, get_script_id, read_usage
+from .sweep_utils import collect_ran_rfs, open_rf_file
+
+def collect_usage(project_dir, script_file, rfs=None):
+    """
+    Return a dictionary relating each finished or failed rf of script_file to
+    the resource usage of its latest run, as recorded in its usage.txt.
+    """
+    script_id = get_script_id(script_file, project_dir)
+    rf_status = collect_rf_status(project_dir, rfs=rfs, script=script_file)
+    usages = {}
+    for rf in rf_status[Status.FINISHED] | rf_status[Status.FAILED] | rf_status[Status.TIMEOUT]:
+        runs = [usage for usage in read_usage(project_dir, rf)
+            if usage['script_id'] == script_id]
+        if runs:
+            usages[rf] = runs[-1]
+    return usages
+
+def predict_usage(project_dir, script_file, rfs, cost=None, k=3, samples=1000, merge=True):
+    """
+    Return a dictionary relating each rf in rfs to its predicted wall time in
+    seconds and peak memory in MB when run with script_file.
+
+    cost may give Python expressions in the parameters of an rf for either,
+    e.g. {"time": "a * c**2", "memory": "100 + 10*a"}. Otherwise usage is
+    averaged over the k rfs nearest in parameter space among a sample of
+    the rfs which were run with any version of script_file before. merge is
+    passed on to the index (see sweep_utils.read_index).
+    """
+    cost = cost or {}
+    params = {}
+    for rf in rfs:
+        with open_rf_file(project_dir,rf,'params.json','r') as param_file:
+            params[rf] = json.load(param_file)
+
+    # latest usage of a sample of the rfs run with script_file, drawn from
+    # the index before any of their files are read
+    history = []
+    if not ('time' in cost and 'memory' in cost):
+        ran = sorted(collect_ran_rfs(project_dir, script_file, merge))
+        random.shuffle(ran)
+        for rf in ran:
+            if len(history) == samples:
+                break
+            runs = [usage for usage in read_usage(project_dir, rf)
+                if usage['script_id'].startswith(script_file+'@')]
+            if runs:
+                with open_rf_file(project_dir,rf,'params.json','r') as param_file:
+                    history.append((json.load(param_file), runs[-1]))
+    walls, memories = nearest_usage(history, list(params.values()), k)
+
+    predictions = {}
+    for index, (rf, point) in enumerate(params.items()):
+        variables = dict(vars(math), **point)
+        wall = eval(cost['time'], {'__builtins__': {}}, variables) if 'time' in cost \
+            else float(walls[index])
+        memory = eval(cost['memory'], {'__builtins__': {}}, variables) if 'memory' in cost \
+            else float(memories[index])
+        predictions[rf] = (wall, memory)
+    return predictions
+
+NEAREST_BLOCK = 2**22   # distance terms computed at once by nearest_usage
+
+def nearest_usage(history, points, k):
+    """
+    Return arrays of the mean wall time and peak memory in MB of the k rfs of
+    history, a list of (parameters, usage), nearest to each of points (0 if
+    none has one recorded). The distance between two points sums the squared
+    differences of numerical parameters, scaled to their range over history
+    and points, and 1 for each other parameter which differs.
+    """
+    import numpy as np
+    walls, memories = np.zeros(len(points)), np.zeros(len(points))
+    if not history or not points:
+        return walls, memories
+
+    # numerical parameters as numbers (NaN otherwise), others as codes (0
+    # for numbers)
+    keys = sorted({key for point, _ in history for key in point}
+        | {key for point in points for key in point})
+    codes = {}
+    def encode(encoded):
+        numbers = np.full((len(encoded), len(keys)), np.nan)
+        categories = np.zeros((len(encoded), len(keys)), dtype=np.int64)
+        for row, point in enumerate(encoded):
+            for column, key in enumerate(keys):
+                value = point.get(key)
+                if isinstance(value, (int, float)):
+                    numbers[row, column] = value
+                else:
+                    categories[row, column] = codes.setdefault(
+                        json.dumps(value, sort_keys=True), len(codes) + 1)
+        return numbers, categories
+    known_numbers, known_categories = encode([point for point, _ in history])
+    numbers, categories = encode(points)
+    low = np.fmin(np.fmin.reduce(known_numbers), np.fmin.reduce(numbers))
+    span = np.fmax(np.fmax.reduce(known_numbers), np.fmax.reduce(numbers)) - low
+    scale = np.divide(1, span, out=np.zeros_like(span), where=span > 0)
+    known_numbers, numbers = (known_numbers - low) * scale, (numbers - low) * scale
+
+    fields = []
+    for field, unit, result in (('wall', 1, walls), ('maxrss_kb', 1024, memories)):
+        known = np.array([usage.get(field) is not None for _, usage in history])
+        if known.any():
+            values = np.array([usage[field] / unit for _, usage in history
+                if usage.get(field) is not None])
+            fields.append((known, values, result))
+
+    block = max(1, NEAREST_BLOCK // (len(history) * len(keys) or 1))
+    for start in range(0, len(points), block):
+        chunk = slice(start, start + block)
+        squares = (numbers[chunk, None, :] - known_numbers[None, :, :])**2
+        distances = np.where(np.isnan(squares),
+            categories[chunk, None, :] != known_categories[None, :, :], squares).sum(axis=2)
+        for known, values, result in fields:
+            nearest = min(k, len(values))
+            indices = np.argpartition(distances[:, known], nearest - 1, axis=1)[:, :nearest]
+            result[chunk] = values[indices].mean(axis=1)
+    return walls, memories
+
+def query_stats(project_dir, script_file, by=(), num_procs=None):
+    """
+    Print a summary of the resource usage of the runs of script_file, and of
+    the mean usage per value of each parameter in by.
+    """
+    usages = collect_usage(project_dir, script_file)
+    print("SWEEP STATS: " + get_script_id(script_file, project_dir))
+    if not usages:
+        print("No recorded runs.")
+        return
+
+    walls = [u['wall'] for u in usages.values()]
+    cpus = [u['user'] + u['sys'] for u in usages.values() if u['user'] is not None]
+    rss = [u['maxrss_kb'] / 1024 for u in usages.values() if u['maxrss_kb'] is not None]
+    output = [u['output_bytes'] for u in usages.values() if u['output_bytes'] is not None]
+    failed = sum(1 for u in usages.values() if u['rc'] != 0)
+
+    # periods of the sweep during which no run was active
+    intervals = sorted((u['start'], u['start'] + u['wall']) for u in usages.values())
+    span = max(end for _, end in intervals) - intervals[0][0]
+    gaps, busy_until = [], intervals[0][1]
+    for start, end in intervals:
+        if start > busy_until:
+            gaps.append(start - busy_until)
+        busy_until = max(busy_until, end)
+    num_procs = num_procs or os.cpu_count()
+
+    print_row("runs", "%d (%d failed)" % (len(usages), failed))
+    print_row("wall time", summarize(walls, "s"))
+    print_row("CPU time", summarize(cpus, "s"))
+    print_row("peak RSS", summarize(rss, "MB"))
+    print_row("output", "%d bytes" % sum(output))
+    print_row("sweep span", "%.1fs" % span)
+    print_row("concurrency", "%.2f runs on average" % (sum(walls) / span if span else 0))
+    print_row("core usage", "%.1f%% of %d cores" %
+        (100 * sum(cpus) / (span * num_procs) if span else 0, num_procs))
+    print_row("idle gaps", "%d, %.1fs in total, longest %.1fs" %
+        (len(gaps), sum(gaps), max(gaps, default=0)))
+
+    for param in by:
+        groups = {}
+        for rf, usage in usages.items():
+            with open_rf_file(project_dir,rf,'params.json','r') as param_file:
+                value = json.load(param_file).get(param)
+            groups.setdefault(json.dumps(value), []).append(usage)
+        print("BY " + param + ":")
+        for value, group in sorted(groups.items(), key=lambda item: sort_key(item[0])):
+            cpus = [u['user'] + u['sys'] for u in group if u['user'] is not None]
+            print_row(value, "%4d runs, wall %s, CPU %s" % (len(group),
+                summarize([u['wall'] for u in group], "s"), summarize(cpus, "s")))
+
+def sort_key(value):
+    # numbers in numerical order, followed by other values
+    number = json.loads(value)
+    return (0, number, "") if isinstance(number, (int, float)) else (1, 0, value)
+
+def summarize(values, unit):
+    if not values:
+        return "----"
+    return "mean %.2f%s, max %.2f%s" % (statistics.mean(values), unit, max(values), unit)
+
+def print_row(name, value):
+    print(str(name).rjust(13) + ": " + value)
@@ -2,8 +2,62 @@ import sys, os, os.path as path
 import argparse
 import datetime
 import enum
+import functools
 import hashlib
+import io
 import json
+import mmap
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import zipfile
+from contextlib import closing, contextmanager
+
+# ---------------------------------------------------------------------------
+# Project configuration: project_dir/config.json records the layout of the
+# rfs folder. With a fanout of n, each rf lives n levels of folders named by
+# pairs of hex digits of its name deep, e.g. rfs/ab/cd/abcd... for n = 2, so
+# that no folder holds more than a few thousand entries.
+CONFIG_FILE = 'config.json'
+LOG_FILE = 'log.gz'      # output of the runs of an rf (see sweep_log)
+LOG_INDEX = 'log.idx'   # offsets of the runs in the log
+# files of an rf which are not results of a run; log.txt is the log of rfs
+# run before logs were compressed
+RF_FILES = (LOG_FILE, LOG_INDEX, 'log.txt', 'params.json', 'status.txt', 'usage.txt')
+
+@functools.lru_cache(maxsize=None)
+def read_config(project_dir):
+    config_path = path.join(project_dir, CONFIG_FILE)
+    config = {'fanout': 0}
+    if path.exists(config_path):
+        with open(config_path) as file:
+            config.update(json.load(file))
+    return config
+
+def write_config(project_dir, config):
+    config_path = path.join(project_dir, CONFIG_FILE)
+    with open(config_path + '.tmp', 'w') as file:
+        json.dump(config, file, indent=4, sort_keys=True)
+    os.replace(config_path + '.tmp', config_path)
+    read_config.cache_clear()
+
+def get_rf_path(project_dir, rf, fanout=None):
+    if fanout is None:
+        fanout = read_config(project_dir)['fanout']
+    return path.join(project_dir, 'rfs', *(rf[2*i:2*i+2] for i in range(fanout)), rf)
+
+def list_rfs(project_dir):
+    """
+    Return the names of all entries in the rfs folder of project_dir which
+    are not hidden, i.e. of the rfs and any stray files.
+    """
+    parents = [path.join(project_dir,'rfs')]
+    for _ in range(read_config(project_dir)['fanout']):
+        parents = [entry.path for parent in parents for entry in os.scandir(parent)
+            if entry.name[0] != '.' and entry.is_dir()]
+    return [name for parent in parents for name in os.listdir(parent) if name[0] != '.']
 
 def read_params(rf,params=None):
     if params is None:
@@ -11,6 +65,19 @@ def read_params(rf,params=None):
             params = json.load(param_file)
     return argparse.Namespace(**params)
 
+def write_result(rf, array, name='result'):
+    """
+    Save array as the result name of the run folder rf, in the .npy format
+    which close collects into one array over the sweep (see
+    close_sweep.get_array) if every rf has a result of the same shape and
+    dtype.
+    """
+    import numpy
+    temp_path = path.join(rf, '.' + name + '.npy')
+    with open(temp_path, 'wb') as file:
+        numpy.save(file, numpy.ascontiguousarray(array))
+    os.replace(temp_path, path.join(rf, name + '.npy'))
+
 def get_timestamp():
     return datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
 
@@ -30,6 +97,21 @@ def get_script_id(script_file, project_dir):
         contents = file.read()
         return script_file + "@" + hashlib.md5(contents.encode('utf-8')).hexdigest()
 
+def write_usage(project_dir, rf, usage):
+    """
+    Append the resource usage of a run of rf, a dictionary, to its usage.txt
+    as a line of JSON.
+    """
+    with open(path.join(get_rf_path(project_dir,rf),'usage.txt'), 'a') as file:
+        write(file, json.dumps(usage, sort_keys=True))
+
+def read_usage(project_dir, rf):
+    try:
+        with open_rf_file(project_dir, rf, 'usage.txt', 'r') as file:
+            return [json.loads(line) for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
 def get_param_id(project_dir,sweep_file):
     sweep_filepath = os.path.join(project_dir,sweep_file)
     with open(sweep_filepath) as file:
@@ -40,65 +122,554 @@ def get_param_id(project_dir,sweep_file):
 
 class Status(enum.Enum):
     RUNNING = 3
+    SPECULATIVE = 6     # running, with a duplicate run racing it
+    RETRYING = 5        # failed transiently, to be run again after a backoff
     QUEUED = 2
     FINISHED = 1
     FAILED = -1
+    TIMEOUT = -2        # killed for running out of time
     NEW = 0
     INVALID = 4
 
+# statuses of rfs which are run by a sweep, and of rfs which are done
+ACTIVE = (Status.QUEUED, Status.RUNNING, Status.SPECULATIVE, Status.RETRYING)
+DONE = (Status.FINISHED, Status.FAILED, Status.TIMEOUT)
+
 def generate_status(action, script_id):
     return " | ".join((action, get_timestamp(), script_id))
 
+def next_status(status, action):
+    if status is Status.NEW:
+        if action == "QUEUED":
+            return Status.QUEUED
+        return Status.INVALID
+    elif status is Status.QUEUED:
+        if action == "STARTED":
+            return Status.RUNNING
+        elif action == "KILLED":
+            return Status.NEW
+        return Status.INVALID
+    elif status in (Status.RUNNING, Status.SPECULATIVE):
+        if action == "FINISHED":
+            return Status.FINISHED
+        elif action == "FAILED":
+            return Status.FAILED
+        elif action == "TIMEOUT":
+            return Status.TIMEOUT
+        elif action == "RETRYING" and status is Status.RUNNING:
+            return Status.RETRYING
+        elif action in ("SPECULAT", "SPECULATED") and status is Status.RUNNING:
+            # SPECULATED was written by earlier versions, out of alignment
+            return Status.SPECULATIVE
+        return Status.INVALID
+    elif status is Status.RETRYING:
+        if action == "STARTED":
+            return Status.RUNNING
+        elif action == "KILLED":
+            return Status.NEW
+        return Status.INVALID
+    elif status in DONE:
+        if action == "QUEUED":
+            return Status.QUEUED
+        elif action == "KILLED":
+            return status
+        return Status.INVALID
+    return status
+
 def check_status(rf, project_dir,script=None):
-    with open(path.join(project_dir,'rfs',rf,'status.txt'), 'r') as file:
-        status = Status.NEW
-        for line in file:
-            action, _, script_id = (s.strip() for s in line.split('|'))
-            if script is not None: 
-                if script_id != get_script_id(script,project_dir):
+    script_id = get_script_id(script,project_dir) if script is not None else None
+    return read_status(rf, project_dir, script_id)[0]
+
+def read_status(rf, project_dir, script_id=None):
+    """
+    Return the status of rf for script_id (or any script) from its status.txt,
+    and the total number of lines in the file.
+    """
+    with open_rf_file(project_dir, rf, 'status.txt', 'r') as file:
+        status, updates = Status.NEW, 0
+        for updates, line in enumerate(file, 1):
+            action, _, line_id = (s.strip() for s in line.split('|'))
+            if script_id is not None and line_id != script_id:
+                continue
+            status = next_status(status, action)
+    return status, updates
+
+# ---------------------------------------------------------------------------
+# Status index: project_dir/index.db caches the replayed status of every rf,
+# both over all scripts (script_id '') and per script id, so that queries do
+# not have to reread every status.txt. status.txt remains the source of truth;
+# `sweeps PROJECT reindex` rebuilds the index from it. The number of status
+# updates of each rf is counted so that changed rfs can be found cheaply, and
+# the latest changes of status per script are kept as events (the status
+# before and after, NULL for no status), so that they can be followed.
+INDEX_FILE = 'index.db'
+INDEX_VERSION = 5
+INDEX_EVENTS = 100000
+
+def open_index(project_dir):
+    index_path = path.join(project_dir, INDEX_FILE)
+    db = sqlite3.connect(index_path, timeout=600)
+    if db.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+                # new index, or one written by another version of sweeps
+                db.execute("DROP TABLE IF EXISTS rfs")
+                db.execute("DROP TABLE IF EXISTS status")
+                db.execute("DROP TABLE IF EXISTS packed")
+                db.execute("DROP TABLE IF EXISTS events")
+                db.execute("DROP TABLE IF EXISTS journals")
+                db.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, time REAL, "
+                    "rf TEXT, script_id TEXT, old INTEGER, new INTEGER)")
+                db.execute("CREATE TABLE journals (name TEXT PRIMARY KEY, offset INTEGER)")
+                db.execute("CREATE TABLE packed (rf TEXT PRIMARY KEY, pack TEXT)")
+                db.execute("CREATE TABLE rfs (rf TEXT PRIMARY KEY, updates INTEGER DEFAULT 0)")
+                db.execute("CREATE TABLE status (rf TEXT, script_id TEXT, "
+                    "status INTEGER, PRIMARY KEY (rf, script_id))")
+                fill_index(project_dir, db)
+                db.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+    return db
+
+def reindex(project_dir):
+    with closing(open_index(project_dir)) as db, db:
+        db.execute("BEGIN IMMEDIATE")
+        fill_index(project_dir, db)
+
+def fill_index(project_dir, db):
+    # journals are merged up to where they are read before the status files
+    db.execute("DELETE FROM journals")
+    _, offsets = read_journals(project_dir, db)
+    rfs, rows = [], []
+    folders = set(list_rfs(project_dir))
+    packed = {rf: pack for rf, pack in scan_packs(project_dir).items() if rf not in folders}
+    for rf in sorted(folders | set(packed)):
+        if rf in packed:
+            file = io.TextIOWrapper(open_pack(project_dir, packed[rf]).open(rf+'/status.txt'))
+        elif path.isdir(get_rf_path(project_dir,rf)):
+            file = open(path.join(get_rf_path(project_dir,rf),'status.txt'), 'r')
+        else:
+            print('!! File', rf, 'in rfs directory is not a run folder. '
+                'It has been skipped.')
+            continue
+        with file:
+            statuses, updates = replay_status(file)
+        rfs.append((rf, updates))
+        rows.extend((rf, key, status.value) for key, status in statuses.items())
+    db.execute("DELETE FROM rfs")
+    db.execute("DELETE FROM status")
+    db.execute("DELETE FROM packed")
+    db.executemany("INSERT INTO rfs VALUES (?,?)", rfs)
+    db.executemany("INSERT INTO status VALUES (?,?,?)", rows)
+    db.executemany("INSERT INTO packed VALUES (?,?)", packed.items())
+    db.executemany("INSERT INTO journals VALUES (?,?)", offsets.items())
+    db.execute("INSERT INTO events (time) VALUES (?)", (time.time(),))   # statuses reset
+    read_packs.cache_clear()
+
+def replay_status(file):
+    # the statuses of an rf over all scripts ('') and per script id, from its
+    # open status.txt, and its number of status updates
+    statuses, updates = {}, 0
+    for updates, line in enumerate(file, 1):
+        action, _, script_id = (s.strip() for s in line.split('|'))
+        for key in ('', script_id):
+            statuses[key] = next_status(statuses.get(key, Status.NEW), action)
+    return statuses, updates
+
+def replay_rfs(project_dir, rfs):
+    replayed = {}
+    for rf in rfs:
+        try:
+            with open_rf_file(project_dir, rf, 'status.txt', 'r') as file:
+                replayed[rf] = replay_status(file)
+        except FileNotFoundError:
+            pass
+    return replayed
+
+def index_rfs(project_dir, rfs, delete=False):
+    with closing(open_index(project_dir)) as db, db:
+        now = time.time()
+        if delete:
+            db.executemany("DELETE FROM rfs WHERE rf=?", ((rf,) for rf in rfs))
+            db.executemany("DELETE FROM status WHERE rf=?", ((rf,) for rf in rfs))
+            db.executemany("INSERT INTO events (time, rf) VALUES (?,?)",
+                ((now, rf) for rf in rfs))
+        else:
+            for rf in rfs:
+                if db.execute("INSERT OR IGNORE INTO rfs (rf) VALUES (?)", (rf,)).rowcount:
+                    db.execute("INSERT INTO events (time, rf, new) VALUES (?,?,?)",
+                        (now, rf, Status.NEW.value))
+        prune_events(db)
+
+def index_status(project_dir, rfs, action, script_id):
+    writer = INDEX_WRITERS.get(project_dir)
+    if writer is not None:
+        writer.put(rfs, action, script_id)
+        return
+    with closing(open_index(project_dir)) as db, db:
+        db.execute("BEGIN IMMEDIATE")
+        apply_status(db, time.time(), rfs, action, script_id)
+        prune_events(db)
+
+def apply_status(db, now, rfs, action, script_id):
+    for rf in rfs:
+        db.execute("UPDATE rfs SET updates = updates + 1 WHERE rf=?", (rf,))
+        for key in ('', script_id):
+            row = db.execute("SELECT status FROM status WHERE rf=? AND script_id=?",
+                (rf, key)).fetchone()
+            old = Status(row[0]) if row else Status.NEW
+            status = next_status(old, action)
+            db.execute("INSERT OR REPLACE INTO status VALUES (?,?,?)",
+                (rf, key, status.value))
+            if key:
+                db.execute("INSERT INTO events (time, rf, script_id, old, new) "
+                    "VALUES (?,?,?,?,?)", (now, rf, key, old.value, status.value))
+
+# During a sweep, the status updates of its runs are applied to the index by
+# a thread of its own, over one connection and in transactions of up to
+# INDEX_BATCH rfs or INDEX_DELAY seconds of updates, so that the sweep never
+# waits on the index. The index may lag status.txt by as much, which is
+# written first.
+#
+# Sweeps sharing a project between hosts (--distributed) do not write the
+# index, as SQLite locking is not reliable on network file systems: each
+# appends the rfs it updates to a journal of its own in project_dir/journals,
+# and the commands reading the index merge the journals into it first, by
+# replaying the status.txt of those rfs. The index records how far each
+# journal was merged.
+INDEX_BATCH = 1000
+INDEX_DELAY = 0.2   # seconds
+INDEX_WRITERS = {}
+JOURNALS_DIR = 'journals'
+
+class IndexWriter:
+    """
+    Apply status updates to the index of project_dir in batches, from a
+    thread started on creation and stopped by close, or list the rfs updated
+    in the file journal if given.
+    """
+    def __init__(self, project_dir, journal=None):
+        self.project_dir = project_dir
+        self.journal = journal
+        self.updates = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, rfs, action, script_id):
+        self.updates.put((time.time(), list(rfs), action, script_id))
+
+    def run(self):
+        try:
+            with closing(open_index(self.project_dir)) if self.journal is None\
+                    else open(self.journal, 'a') as target:
+                closed = False
+                while not closed:
+                    batch = [self.updates.get()]
+                    deadline = time.time() + INDEX_DELAY
+                    size = len(batch[0][1]) if batch[0] else 0
+                    while batch[-1] is not None and size < INDEX_BATCH:
+                        try:
+                            batch.append(self.updates.get(
+                                timeout=max(0, deadline - time.time())))
+                        except queue.Empty:
+                            break
+                        size += len(batch[-1][1]) if batch[-1] else 0
+                    closed = batch[-1] is None
+                    self.apply(target, [update for update in batch if update is not None])
+        except Exception as error:
+            self.error = error
+
+    def apply(self, target, batch):
+        # target is the open journal, or else the index
+        if batch and self.journal is not None:
+            target.write(''.join(rf + '\n' for _, rfs, _, _ in batch for rf in rfs))
+            target.flush()
+        elif batch:
+            with target as db:
+                db.execute("BEGIN IMMEDIATE")
+                for update in batch:
+                    apply_status(db, *update)
+                prune_events(db)
+
+    def close(self):
+        """
+        Apply the updates left and stop; an error of the thread is raised
+        here, after which `sweeps PROJECT reindex` brings the index up to
+        date again.
+        """
+        self.updates.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+@contextmanager
+def index_writer(project_dir, journal=False):
+    """
+    Apply the status updates of write_status to the index of project_dir
+    through an IndexWriter, within the context, or list them in a journal of
+    this process if journal.
+    """
+    journal_path = None
+    if journal:
+        os.makedirs(path.join(project_dir, JOURNALS_DIR), exist_ok=True)
+        journal_path = path.join(project_dir, JOURNALS_DIR,
+            socket.gethostname() + '-' + str(os.getpid()) + '.txt')
+    writer = INDEX_WRITERS[project_dir] = IndexWriter(project_dir, journal_path)
+    try:
+        yield writer
+    finally:
+        del INDEX_WRITERS[project_dir]
+        writer.close()
+
+def prune_events(db):
+    db.execute("DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?",
+        (INDEX_EVENTS,))
+
+def read_journals(project_dir, db):
+    """
+    Return the rfs listed in the journals past the offsets merged into the
+    index db, and the offsets of the journals read up to.
+    """
+    journals_path = path.join(project_dir, JOURNALS_DIR)
+    if not path.isdir(journals_path):
+        return set(), {}
+    merged = dict(db.execute("SELECT name, offset FROM journals"))
+    rfs, offsets = set(), {}
+    for name in sorted(os.listdir(journals_path)):
+        offset = merged.get(name, 0)
+        with open(path.join(journals_path, name), 'rb') as file:
+            file.seek(offset)
+            data = file.read()
+        data = data[:data.rfind(b'\n') + 1]   # a line being written is left
+        if data:
+            rfs.update(data.decode().split())
+            offsets[name] = offset + len(data)
+    return rfs, offsets
+
+def merge_journals(project_dir, db):
+    """
+    Bring the index db up to date with the journals of distributed sweeps.
+    """
+    if not read_journals(project_dir, db)[1]:
+        return
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        rfs, offsets = read_journals(project_dir, db)
+        now = time.time()
+        for rf, (statuses, updates) in replay_rfs(project_dir, rfs).items():
+            db.execute("INSERT OR REPLACE INTO rfs VALUES (?,?)", (rf, updates))
+            old = dict(db.execute("SELECT script_id, status FROM status WHERE rf=?", (rf,)))
+            for key, status in statuses.items():
+                if old.get(key) == status.value:
                     continue
-            if status is Status.NEW:
-                if action == "QUEUED":
-                    status = Status.QUEUED
-                else:
-                    status = Status.INVALID
-            elif status is Status.QUEUED:
-                if action == "STARTED":
-                    status = Status.RUNNING
-                elif action == "KILLED":
-                    status = Status.NEW
-                else:
-                    status = Status.INVALID
-            elif status is Status.RUNNING:
-                if action == "FINISHED":
-                    status = Status.FINISHED
-                elif action == "FAILED":
-                    status = Status.FAILED
-                else:
-                    status = Status.INVALID
-            elif status in (Status.FAILED, Status.FINISHED):
-                if action == "QUEUED":
-                    status = Status.QUEUED
-                elif action == "KILLED":
-                    status = status
-                else:
-                    status = Status.INVALID
-    return status
+                db.execute("INSERT OR REPLACE INTO status VALUES (?,?,?)",
+                    (rf, key, status.value))
+                if key:
+                    db.execute("INSERT INTO events (time, rf, script_id, old, new) "
+                        "VALUES (?,?,?,?,?)",
+                        (now, rf, key, old.get(key, Status.NEW.value), status.value))
+        db.executemany("INSERT OR REPLACE INTO journals VALUES (?,?)", offsets.items())
+        prune_events(db)
+
+def write_status(project_dir, rfs, action, script_id):
+    """
+    Append action to the status.txt of each rf in rfs and update the index,
+    or queue the update within index_writer.
+    """
+    line = generate_status(action, script_id)
+    for rf in rfs:
+        with open(path.join(get_rf_path(project_dir,rf),'status.txt'), 'a') as file:
+            write(file, line)
+    index_status(project_dir, rfs, action.strip(), script_id)
 
-def collect_rf_status(project_dir,rfs=None,script=None):
-    if rfs == None: rfs = os.listdir(path.join(project_dir,'rfs'))
+def read_index(project_dir, merge):
+    # an open index with the journals merged, or, if not merge (as within
+    # distributed sweeps), with the replayed status.txt of the rfs left in
+    # the journals
+    db = open_index(project_dir)
+    if merge:
+        merge_journals(project_dir, db)
+        return db, {}
+    return db, replay_rfs(project_dir, read_journals(project_dir, db)[0])
+
+def collect_rf_updates(project_dir, merge=True):
+    """
+    Return a dictionary relating each rf to its number of status updates.
+    """
+    db, replayed = read_index(project_dir, merge)
+    with closing(db):
+        updates = dict(db.execute("SELECT rf, updates FROM rfs"))
+    updates.update((rf, count) for rf, (_, count) in replayed.items())
+    return updates
+
+def collect_ran_rfs(project_dir, script_file, merge=True):
+    """
+    Return the rfs whose latest run with some version of script_file ended,
+    as FINISHED, FAILED or TIMEOUT.
+    """
+    ended = {Status.FINISHED, Status.FAILED, Status.TIMEOUT}
+    prefix = script_file + '@'
+    db, replayed = read_index(project_dir, merge)
+    with closing(db):
+        rows = db.execute("SELECT rf, script_id, status FROM status "
+            "WHERE substr(script_id, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+    ran = {rf for rf, _, status in rows if Status(status) in ended and rf not in replayed}
+    ran.update(rf for rf, (statuses, _) in replayed.items() if any(
+        key.startswith(prefix) and status in ended for key, status in statuses.items()))
+    return ran
+
+def collect_rf_status(project_dir,rfs=None,script=None,merge=True):
+    script_id = get_script_id(script,project_dir) if script is not None else ''
+    db, replayed = read_index(project_dir, merge)
+    with closing(db):
+        indexed = {rf for rf, in db.execute("SELECT rf FROM rfs")}
+        statuses = dict(db.execute("SELECT rf, status FROM status WHERE script_id=?",
+            (script_id,)))
+    for rf, (replay, _) in replayed.items():
+        indexed.add(rf)
+        statuses[rf] = replay.get(script_id, Status.NEW).value
+
+    if rfs == None: rfs = indexed
 
     status_table = {e : set() for e in Status}
     for rf in rfs:
-        if os.path.isdir(path.join(project_dir,'rfs',rf)):   # Check that path is a directory
-            status = check_status(rf, project_dir, script)
-            status_table[status].add(rf)
+        if rf in indexed:
+            status_table[Status(statuses.get(rf, Status.NEW.value))].add(rf)
         else:
-            if rf[0] != '.':    # Check if file is a hidden system file
-                print('!! File', rf, 'in rfs directory is not a run folder. '
-                    'It has been skipped.')
+            print('!! Run folder', rf, 'is not in the index. It has been skipped.')
     return status_table
 
+# ---------------------------------------------------------------------------
+# Packs: `sweeps PROJECT pack` moves finished rfs into zip archives in
+# project_dir/packs, holding the files of each rf under <rf>/. The index
+# relates packed rfs to their archive; rfs deleted from an archive are listed
+# in packs/deleted.txt, and a folder of an rf takes precedence over archives,
+# so archives are only ever appended. Results are stored uncompressed, so
+# that they can be memory-mapped from the archive.
+PACKS_DIR = 'packs'
+
+@functools.lru_cache(maxsize=None)
+def read_packs(project_dir):
+    """
+    Return a dictionary relating each packed rf to its archive.
+    """
+    with closing(open_index(project_dir)) as db:
+        return dict(db.execute("SELECT rf, pack FROM packed"))
+
+def scan_packs(project_dir):
+    # rfs of the archives, from the central directories of the archives
+    packs_path = path.join(project_dir, PACKS_DIR)
+    if not path.isdir(packs_path):
+        return {}
+    packed = {}
+    for pack in sorted(os.listdir(packs_path)):
+        if pack.endswith('.zip'):
+            for name in open_pack(project_dir, pack).namelist():
+                packed[name.split('/', 1)[0]] = pack
+    deleted_path = path.join(packs_path, 'deleted.txt')
+    if path.exists(deleted_path):
+        with open(deleted_path) as file:
+            for line in file:
+                pack, rf = line.split()
+                if packed.get(rf) == pack:
+                    del packed[rf]
+    return packed
+
+def open_pack(project_dir, pack):
+    # one handle per process, as forked processes would share its offset
+    return open_pack_in(project_dir, pack, os.getpid())
+
+@functools.lru_cache(maxsize=32)
+def open_pack_in(project_dir, pack, pid):
+    return zipfile.ZipFile(path.join(project_dir, PACKS_DIR, pack))
+
+@functools.lru_cache(maxsize=32)
+def map_pack(project_dir, pack):
+    with open(path.join(project_dir, PACKS_DIR, pack), 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def index_packs(project_dir, packed, delete=False):
+    """
+    Relate the rfs of packed to their archives in the index, or remove them.
+    """
+    with closing(open_index(project_dir)) as db, db:
+        if delete:
+            db.executemany("DELETE FROM packed WHERE rf=?", ((rf,) for rf in packed))
+        else:
+            db.executemany("INSERT OR REPLACE INTO packed VALUES (?,?)", packed.items())
+    read_packs.cache_clear()
+
+def list_rf_files(project_dir, rf):
+    """
+    Return the names of the files directly in the folder of rf, or in its
+    archive if it is packed.
+    """
+    rf_path = get_rf_path(project_dir, rf)
+    pack = None if path.isdir(rf_path) else read_packs(project_dir).get(rf)
+    if pack is None:
+        return os.listdir(rf_path)
+    prefix = rf + '/'
+    return [name[len(prefix):] for name in open_pack(project_dir, pack).namelist()
+        if name.startswith(prefix) and '/' not in name[len(prefix):]]
+
+def open_rf_file(project_dir, rf, name, mode='rb'):
+    """
+    Open the file name of rf for reading, from its folder or, if it is
+    packed, from its archive; mode is 'rb' or 'r'. Files stored in archives
+    uncompressed are memory-mapped.
+    """
+    rf_path = get_rf_path(project_dir, rf)
+    pack = None if path.isdir(rf_path) else read_packs(project_dir).get(rf)
+    if pack is None:
+        return open(path.join(rf_path, name), mode)
+    try:
+        info = open_pack(project_dir, pack).getinfo(rf + '/' + name)
+    except KeyError:
+        raise FileNotFoundError("No file " + name + " in packed rf " + rf) from None
+    if info.compress_type == zipfile.ZIP_STORED:
+        # data follows the local header, whose name and extra field lengths
+        # may differ from the central directory
+        mapped = map_pack(project_dir, pack)
+        offset = info.header_offset
+        start = offset + 30 + int.from_bytes(mapped[offset+26:offset+28], 'little')\
+            + int.from_bytes(mapped[offset+28:offset+30], 'little')
+        file = MappedFile(memoryview(mapped)[start:start+info.file_size])
+    else:
+        file = open_pack(project_dir, pack).open(info)
+    return io.TextIOWrapper(file, encoding='utf-8') if mode == 'r' else file
+
+class MappedFile(io.RawIOBase):
+    """
+    Read-only file over a memoryview, e.g. of a memory-mapped archive; the
+    view itself is returned by getbuffer().
+    """
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.view) - self.position)
+        buffer[:size] = self.view[self.position:self.position+size]
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = (0, self.position, len(self.view))[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def getbuffer(self):
+        return self.view
+
 def query_status(project_dir, script_file):
     print("SWEEP SUMMARY: " + get_script_id(script_file, project_dir))
     for status,rfs in collect_rf_status(project_dir,script=script_file).items():
@@ -0,0 +1,159 @@
+import os, os.path as path
+import collections
+import ctypes, ctypes.util
+import json
+import select
+import time
+from contextlib import closing
+
+from .sweep_utils import INDEX_FILE, ACTIVE, DONE, Status, open_index, get_script_id, get_timestamp
+from .sweep_utils import JOURNALS_DIR, merge_journals
+
+IN_MODIFY = 0x00000002
+
+def watch_status(project_dir, script_file, interval=1.0, json_lines=False, until_done=False,
+        window=60):
+    """
+    Print the number of rfs of each status for script_file whenever it
+    changes, at most every interval seconds, with the throughput of rfs over
+    the last window seconds and the time left for the queued and running rfs
+    at that throughput. If json_lines, print each update as a line of JSON.
+    If until_done, return once rfs have been queued or running, and none
+    are anymore.
+
+    Updates follow the status events of the index, which is watched with
+    inotify where available and by its modification time otherwise, so that
+    the cost of an update does not depend on the size of the sweep. The
+    journals of distributed sweeps are merged into the index as they grow.
+    """
+    script_id = get_script_id(script_file, project_dir)
+    index_path = path.join(project_dir, INDEX_FILE)
+    notifier = watch_file(index_path)
+    try:
+        with closing(open_index(project_dir)) as db:
+            merge_journals(project_dir, db)
+            tally, last, finish_times = count_status(db, script_id, window)
+            modified = index_modified(project_dir)
+            active = False
+            while True:
+                now = time.time()
+                while finish_times and finish_times[0] < now - window:
+                    finish_times.popleft()
+                throughput = len(finish_times) / window
+                remaining = sum(tally[status] for status in ACTIVE)
+                report(script_id, tally, throughput, remaining / throughput\
+                    if throughput else None, json_lines)
+                if until_done and active and not remaining:
+                    return
+                active = active or remaining > 0
+
+                # wait for the index to change, then apply its new events
+                time.sleep(max(0, now + interval - time.time()))
+                changed = tally.copy()
+                while changed == tally:
+                    modified = wait_modified(notifier, project_dir, modified, interval)
+                    merge_journals(project_dir, db)
+                    events = db.execute("SELECT id, time, script_id, old, new FROM events "
+                        "WHERE id > ? ORDER BY id", (last,)).fetchall()
+                    if (events and events[0][0] != last + 1) or\
+                            any(key is None and new is None for _, _, key, _, new in events)\
+                            or (not events and last > max_event(db)):
+                        # events missed, or rfs deleted or reindexed
+                        changed, last, finish_times = count_status(db, script_id, window)
+                        break
+                    for last, event_time, key, old, new in events:
+                        if key is None:
+                            changed[Status(new)] += 1  # rf created
+                        elif key == script_id:
+                            changed[Status(old)] -= 1
+                            changed[Status(new)] += 1
+                            if Status(new) in DONE:
+                                finish_times.append(event_time)
+                tally = changed
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if notifier is not None:
+            os.close(notifier)
+
+def count_status(db, script_id, window):
+    """
+    Return the number of rfs of each status for script_id in the index, the
+    id of its latest event, and the times rfs finished or failed in the last
+    window seconds.
+    """
+    with db:
+        db.execute("BEGIN")     # a consistent snapshot of the index
+        total, = db.execute("SELECT COUNT(*) FROM rfs").fetchone()
+        tally = collections.Counter({status: 0 for status in Status})
+        for status, count in db.execute("SELECT status, COUNT(*) FROM status "
+                "WHERE script_id=? GROUP BY status", (script_id,)):
+            tally[Status(status)] += count
+        tally[Status.NEW] += total - sum(tally.values())
+        last = max_event(db)
+        finish_times = collections.deque(event_time for event_time, in db.execute(
+            "SELECT time FROM events WHERE script_id=? AND new IN (?,?,?) AND time > ? "
+            "ORDER BY id", (script_id, *(status.value for status in DONE),
+            time.time() - window)))
+    return tally, last, finish_times
+
+def max_event(db):
+    return db.execute("SELECT MAX(id) FROM events").fetchone()[0] or 0
+
+def report(script_id, tally, throughput, eta, json_lines):
+    if json_lines:
+        record = dict(time=time.time(), script_id=script_id, throughput=throughput, eta=eta)
+        record.update((status.name, tally[status]) for status in Status)
+        print(json.dumps(record), flush=True)
+        return
+    counts = "  ".join(status.name + ": " + str(tally[status]) for status in Status)
+    eta = "----" if eta is None else "%dh%02dm%02ds" % (eta // 3600, eta % 3600 // 60, eta % 60)
+    print(get_timestamp() + "  " + counts + "  | %.2f rfs/s, ETA %s" % (throughput, eta),\
+        flush=True)
+
+def watch_file(filepath):
+    """
+    Return an inotify file descriptor reporting modifications of filepath, or
+    None where inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        notifier = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if notifier < 0:
+        return None
+    if libc.inotify_add_watch(notifier, os.fsencode(filepath), IN_MODIFY) < 0:
+        os.close(notifier)
+        return None
+    return notifier
+
+def index_modified(project_dir):
+    # the modification times and sizes of the index and of the journals
+    paths = [path.join(project_dir, INDEX_FILE)]
+    journals_path = path.join(project_dir, JOURNALS_DIR)
+    if path.isdir(journals_path):
+        paths.extend(path.join(journals_path, name) for name in sorted(os.listdir(journals_path)))
+    return [(stat.st_mtime_ns, stat.st_size) for stat in map(os.stat, paths)]
+
+def wait_modified(notifier, project_dir, modified, interval):
+    """
+    Wait until the index or the journals are modified after modified, their
+    modification times and sizes; returns the new ones. Without inotify, or
+    for writes by other hosts which inotify does not see, they are polled
+    every interval seconds.
+    """
+    while True:
+        notified = False
+        if notifier is not None:
+            notified = bool(select.select([notifier], [], [], interval)[0])
+            while notified:
+                try:
+                    os.read(notifier, 65536)
+                except BlockingIOError:
+                    break
+        else:
+            time.sleep(interval)
+        current = index_modified(project_dir)
+        if notified or current != modified:
+            return current
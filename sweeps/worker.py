@@ -0,0 +1,75 @@
+"""
+Warm worker for `sweeps run --warm`. Imports a Python script once, then calls
+its entry function for every run folder path read from stdin, with stdout and
+stderr going to the worker's stderr, which sweeps pipes into the log of the
+run folder being run. For each run folder, a line
+"EXIT_CODE USER_TIME SYS_TIME MAXRSS_KB" is reported back on the original
+stdout, with the CPU times of the run and the peak memory of the worker.
+
+This file is executed by the interpreter given to `sweeps run` and must only
+depend on the standard library.
+
+Usage: python worker.py SCRIPT ENTRY
+"""
+import sys, os, os.path as path
+import inspect
+import json
+import resource
+import runpy
+import traceback
+
+def main():
+    script_path, entry = sys.argv[1:3]
+
+    # keep the original stdout as control channel; all output goes to stderr,
+    # which is logged for the rf being run, if any
+    control = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    sys.argv = [script_path]
+    sys.path[0] = path.dirname(path.abspath(script_path))
+    function = runpy.run_path(script_path, run_name='__sweeps__')[entry]
+    takes_params = 'params' in inspect.signature(function).parameters
+
+    for line in sys.stdin:
+        before = cpu_times()
+        rc = run(function, line.rstrip('\n'), takes_params)
+        user, system = (after - b for after, b in zip(cpu_times(), before))
+        maxrss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            maxrss_kb //= 1024
+        control.write("%d %f %f %d\n" % (rc, user, system, maxrss_kb))
+        control.flush()
+
+def cpu_times():
+    # including processes started by the script during the run
+    usages = [resource.getrusage(who)
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime for u in usages), sum(u.ru_stime for u in usages)
+
+def run(function, rf_path, takes_params=False):
+    sys.argv = [sys.argv[0], rf_path]
+    try:
+        if takes_params:
+            with open(path.join(rf_path,'params.json')) as param_file:
+                function(json.load(param_file))
+        else:
+            function(rf_path)
+        rc = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            rc = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            rc = 1
+    except Exception:
+        traceback.print_exc()
+        rc = 1
+    finally:
+        # all output of the run is written before it is reported
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return rc
+
+if __name__ == "__main__":
+    main()